@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 #Copyright 2011, 2012 Mark Santesson
 #
@@ -25,24 +25,112 @@ of each other will all be the same number.
 By Mark Santesson.
 '''
 
-import time, os, sys, collections
-
-
-timings = []
-last_time = time.clock()
-
-def elapsedTime():
-    '''Return the number of seconds that has passed since the last time this
-    function was called. The first time it is called it will return the time
-    since the function was defined.'''
-    global last_time
-    this_time = time.clock()
-    elap_time = this_time - last_time
-    last_time = this_time
-    return elap_time
-
-def addTiming(desc):
-    timings.append( ( elapsedTime(), desc, ) )
+import time, os, sys, collections, functools, pickle, bisect, json
+import multiprocessing, socketserver, socket, io, stat
+import itertools, shutil, tempfile, unittest
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # Only needed for the "counts" engine.
+
+
+class Instrumentation:
+    '''Measurements for one piece of work: loading a dictionary, or
+    solving one phrase. Phases are timed with time.perf_counter, and
+    the solvers count what they do as they go, so that it can be
+    seen why one phrase takes so much longer than another.'''
+    def __init__(self, name):
+        self.name = name
+        self.phases = []        # ( description, seconds ) in order
+        self.rows = 0           # Anagrams produced.
+        self.nodes = 0          # Recursion nodes visited.
+        self.memo_hits = 0      # Nodes answered from the memo.
+        self.considered = []    # Keys looked at, by depth.
+        self.kept = []          # Keys that fit the letters, by depth.
+        self.peak_candidates = 0    # Longest list of keys that fit.
+        self.__last = time.perf_counter()
+
+    def addPhase(self, desc):
+        '''Record that the phase desc has finished. It is taken to
+        have started when the previous phase finished, or when this
+        object was made.'''
+        this_time = time.perf_counter()
+        self.phases.append( ( desc, this_time - self.__last, ) )
+        self.__last = this_time
+
+    def visitNode(self, depth, considered, kept):
+        '''Record a node of the search at the given depth that
+        filtered considered keys down to kept.'''
+        self.nodes += 1
+        try:
+            self.considered[depth] += considered
+            self.kept[depth] += kept
+        except IndexError:
+            while len(self.kept) < depth:
+                self.considered.append( 0 )
+                self.kept.append( 0 )
+            self.considered.append( considered )
+            self.kept.append( kept )
+        if kept > self.peak_candidates:
+            self.peak_candidates = kept
+
+    def merge(self, other):
+        '''Add in the search counters of other, which measured
+        part of the same work (in a worker process, say).'''
+        self.nodes += other.nodes
+        self.memo_hits += other.memo_hits
+        while len(self.kept) < len(other.kept):
+            self.considered.append( 0 )
+            self.kept.append( 0 )
+        for depth,(considered,kept) in enumerate( zip(other.considered, other.kept) ):
+            self.considered[depth] += considered
+            self.kept[depth] += kept
+        self.peak_candidates = max( self.peak_candidates, other.peak_candidates )
+
+    def asDict(self):
+        '''Return the measurements as a dict that can be written
+        out as JSON.'''
+        return { 'name'            : self.name
+               , 'phases'          : [ { 'phase' : desc, 'seconds' : et }
+                                       for desc,et in self.phases ]
+               , 'seconds'         : sum( et for desc,et in self.phases )
+               , 'rows'            : self.rows
+               , 'nodes'           : self.nodes
+               , 'memo_hits'       : self.memo_hits
+               , 'keys_considered' : self.considered
+               , 'keys_kept'       : self.kept
+               , 'peak_candidates' : self.peak_candidates
+               }
+
+
+
+# Ways AnagramGenerator can search. See its constructor.
+ENGINES = ( 'primes', 'counts' )
+
+# The "counts" engine hands a subtree to the "primes" engine once
+# fewer candidate keys than this are left.
+COUNTS_MIN_ROWS = 256
+
+# The compiled signatures for a dictionary are cached in a file with
+# this suffix next to it. Bump the version when the layout changes.
+CACHE_SUFFIX = '.sigcache'
+CACHE_VERSION = 1
+
+# Size of the memo of solved subproblems (remaining letters and first
+# key) kept by each AnagramGenerator. The least recently used entries
+# are dropped beyond memo_size entries, and subproblems with more than
+# MEMO_MAX_ROWS answers are not kept at all.
+MEMO_SIZE = 100000
+MEMO_MAX_ROWS = 1000
+
+# With more than one job, the top of the search tree is split into at
+# least this many branches per job, so that a few big branches do not
+# leave the other processes idle. Splitting stops after
+# MAX_SPLIT_DEPTH levels.
+BRANCHES_PER_JOB = 8
+MAX_SPLIT_DEPTH = 3
 
 
 
@@ -87,11 +175,43 @@ class AnagramGenerator:
     that are possible from the input phrase using the given dictionary.
     If no dictionary is given to the constructor (as a filename)
     then it assumes "words" is the filename.'''
-    def __init__(self, dictionary_filename='words'):
+    def __init__(self, dictionary_filename='words', use_cache=True,
+                engine='primes', jobs=1, memo_size=MEMO_SIZE):
         '''Make a AnagramGenerator object. There is no way to
-        switch dictionaries; create a new instance instead.'''
+        switch dictionaries; create a new instance instead.
+        If use_cache is true, the signatures computed from the
+        dictionary are kept in a file next to it and reused
+        until the dictionary changes.
+        engine selects how the search is done. "primes" divides
+        the product of primes for the remaining letters. "counts"
+        keeps a row of 26 letter counts per signature in a NumPy
+        array and tests all candidate keys at once; it needs numpy.
+        Both produce the same anagrams in the same order.
+        If jobs is more than one, the branches of the search are
+        spread across that many processes. The anagrams still come
+        out in the same order as with one job.
+        Up to memo_size solved subproblems are remembered so that
+        they are not solved again; 0 turns this off.
+        Measurements of the loading are kept in load_stats, and
+        of the last phrase searched in last_run; both are
+        Instrumentation objects.'''
+        if engine not in ENGINES:
+            raise ValueError( 'Unknown engine %r, expected one of %r' % (engine, ENGINES) )
+        if engine == 'counts' and numpy is None:
+            raise ImportError( 'The "counts" engine requires numpy.' )
+
+        self.load_stats = Instrumentation( 'load "%s"' % (dictionary_filename,) )
+        self.last_run = None
         self.dictionary_filename = dictionary_filename
+        self.use_cache = use_cache
+        self.engine = engine
+        self.jobs = jobs
+        self.memo_size = memo_size
+        self.__lengths_keys = dict()
+        self.__memo = collections.OrderedDict() if memo_size > 0 else None
         self.__loadDictionary()
+        if engine == 'counts':
+            self.__buildCounts()
 
     def __getPrime(self, c):
         '''Returns the prime number that represents the passed
@@ -104,7 +224,7 @@ class AnagramGenerator:
         a string.  The integer is the product of the prime number
         representation of each character in the string.'''
         s = s.lower()
-        sig = reduce(lambda x,y: x * self.__getPrime(y),
+        sig = functools.reduce(lambda x,y: x * self.__getPrime(y),
             [ch for ch in s if ord('a') <= ord(ch) <= ord('z')], 1)
         assert sig >= 1, repr( ('Product of primes produced non-positive number',s, sig, [ (z,self.__getPrime(z)) for z in s if ord('a') <= ord(z) <= ord('z') ]) )
         return sig
@@ -113,7 +233,10 @@ class AnagramGenerator:
         '''Load a dictionary from the given input file.  The file
         should have one word per line.'''
 
-        addTiming('Start of loading dictionary from "%s"' % (self.dictionary_filename,))
+        if self.use_cache and self.__loadCache():
+            return
+
+        self.load_stats.addPhase( 'Start of loading dictionary from "%s"' % (self.dictionary_filename,) )
 
         # Count chars in the dictionary. Create a dict of lower
         # case character to the number of instances found in the
@@ -144,7 +267,7 @@ class AnagramGenerator:
         # will be smaller numbers.
 
         primes = prime_generator() # get the prime number generator
-        chars_map = dict( [ (x,primes.next()) for x,y in \
+        chars_map = dict( [ (x,next(primes)) for x,y in \
             sorted( counts.items(), key=lambda i:i[1],
                 reverse=True ) ] )
 
@@ -154,7 +277,7 @@ class AnagramGenerator:
 
         self.chars_list = [ chars_map[chr(x)] for x in range(ord('a'), ord('z') + 1) ]
 
-        addTiming( 'Assign Primes to the alphabet.' )
+        self.load_stats.addPhase( 'Assign Primes to the alphabet.' )
 
 
         # Insert all the dictionary words into the list
@@ -168,12 +291,120 @@ class AnagramGenerator:
         # We need the keys in list form so we can have it sorted.
         # Lookups into the signatures dictionary are pretty rare.
         self.sigs_keys = sorted( self.sigs.keys() )
-        addTiming( 'Create signatures dictionary.' )
-
-    def __getSignatureKeys(self):
+        self.load_stats.addPhase( 'Create signatures dictionary.' )
+
+        if self.use_cache:
+            self.__saveCache()
+
+    def __cacheFilename(self):
+        return self.dictionary_filename + CACHE_SUFFIX
+
+    def __cacheHeader(self):
+        '''Returns what identifies the dictionary the cache was
+        built from. The cache is stale as soon as any of it differs.'''
+        st = os.stat( self.dictionary_filename )
+        return ( CACHE_VERSION, os.path.abspath(self.dictionary_filename),
+                 st.st_mtime_ns, st.st_size )
+
+    def __loadCache(self):
+        '''Load the signatures from the cache file, if there is
+        one and it is not stale. Returns whether it was used.
+        The file holds two pickles: a small header that is
+        checked first, and then the body, which is only read
+        if the header matches. The body keeps the words lists
+        in the same order as sigs_keys so that the keys are
+        not stored twice. A cache that can not be read, for
+        whatever reason, is treated as stale and rebuilt.'''
+        try:
+            with open( self.__cacheFilename(), 'rb' ) as f:
+                if pickle.load( f ) != self.__cacheHeader():
+                    return False
+                chars_list, keys, words = pickle.load( f )
+            if not ( isinstance(chars_list, list) and len(chars_list) == 26
+                     and all( isinstance(x, int) for x in chars_list )
+                     and isinstance(keys, list) and isinstance(words, list)
+                     and len(keys) == len(words) ):
+                return False
+        except Exception:
+            return False    # Truncated, corrupt or from another version.
+
+        self.chars_list = chars_list
+        self.sigs_keys = keys
+        self.sigs = collections.defaultdict( list, zip( keys, words ) )
+        self.load_stats.addPhase( 'Load signatures from cache "%s"' % (self.__cacheFilename(),) )
+        return True
+
+    def __saveCache(self):
+        '''Write the signatures out to the cache file. Failing
+        to write it (a read only directory, say) is not an error.'''
+        filename = self.__cacheFilename()
+        try:
+            with open( filename + '.tmp', 'wb' ) as f:
+                pickle.dump( self.__cacheHeader(), f, pickle.HIGHEST_PROTOCOL )
+                pickle.dump( ( self.chars_list, self.sigs_keys,
+                               [ self.sigs[k] for k in self.sigs_keys ] ),
+                             f, pickle.HIGHEST_PROTOCOL )
+            os.replace( filename + '.tmp', filename )
+        except OSError:
+            return
+        self.load_stats.addPhase( 'Save signatures to cache "%s"' % (filename,) )
+
+    def __getCounts(self, s):
+        '''Returns the number of times each letter of the
+        alphabet appears in a string, as a list of 26 ints.'''
+        counts = [0] * 26
+        for ch in s.lower():
+            if ord('a') <= ord(ch) <= ord('z'):
+                counts[ ord(ch) - ord('a') ] += 1
+        return counts
+
+    def __buildCounts(self):
+        '''Build the letter count matrix used by the "counts"
+        engine: row i holds the letter counts of sigs_keys[i].
+        Any word with a signature has the same letters, so
+        the first one is used.'''
+        self.key_counts = numpy.array(
+                [ self.__getCounts( self.sigs[k][0] ) for k in self.sigs_keys ],
+                dtype=numpy.int16 ).reshape( len(self.sigs_keys), 26 )
+        self.load_stats.addPhase( 'Create letter count matrix.' )
+
+    def __getSignatureKeys(self, lengths=(1, None)):
         '''Returns the sorted list of all signature keys. This is
-        used to populate a list of all available words.'''
-        return self.sigs_keys
+        used to populate a list of all available words. lengths
+        is (min_length, max_length); only keys for words with that
+        many letters are returned. max_length may be None.'''
+        if lengths == (1, None):
+            return self.sigs_keys
+        keys = self.__lengths_keys.get( lengths )
+        if keys is None:
+            min_length,max_length = lengths
+            keys = [ k for k in self.sigs_keys
+                       if min_length <= self.__keyLength(k) and
+                          ( max_length is None or self.__keyLength(k) <= max_length ) ]
+            self.__lengths_keys[ lengths ] = keys
+        return keys
+
+    def __getKeyCounts(self, lengths):
+        '''Returns the rows of the letter count matrix for the keys
+        __getSignatureKeys(lengths) returns.'''
+        if lengths == (1, None):
+            return self.key_counts
+        keep = set( self.__getSignatureKeys(lengths) )
+        return self.key_counts[ [ i for i,k in enumerate(self.sigs_keys) if k in keep ] ]
+
+    def __keyLength(self, sig):
+        '''Returns the number of letters in the words of a signature.'''
+        return sum( self.__getCounts( self.sigs[sig][0] ) )
+
+    def __getCountsFromSignature(self, letters):
+        '''Returns the letter counts, as __getCounts does, of the
+        letters whose primes multiply to the given signature.'''
+        counts = [ 0 ] * 26
+        for index,prime in enumerate(self.chars_list):
+            while letters % prime == 0:
+                letters //= prime
+                counts[index] += 1
+        return counts
 
     def formulateAnagramPhraseCombo(self, res):
         '''Render an anagram "phrase" into text for display. Each key
@@ -184,9 +415,11 @@ class AnagramGenerator:
 
 
     def __solveAnagramPhrase(self, letters, unreduced_keys, start=0, \
-                so_far=[], display_progress=False):
-        '''This is the recursive function that helps produce anagrams.
-        It should not be called directly.'''
+                so_far=[], deadline=None, words_left=None, lengths=(1, None),
+                run=None):
+        '''This is the recursive generator that helps produce
+        anagrams. Each combination of keys is yielded as soon as
+        it is found. It should not be called directly.'''
 
         # letters: Product of signatures of letters remaining.
         # unreduced_keys: Keys representing items in the dictionary
@@ -201,37 +434,404 @@ class AnagramGenerator:
         #    the same key can be used multiple times.
         # so_far: A list containing the keys that have been picked
         #    so far in this chain of recursions.
-        # display_progress: Flag, if true then results are displayed
-        #    as they are discovered.
+        # deadline: time.monotonic() value after which the search
+        #    gives up, or None to search to the end.
+        # words_left: How many more keys may be picked, or None
+        #    for no limit.
+        # lengths: The word lengths the keys were filtered to, as
+        #    passed to __getSignatureKeys.
+        # run: Instrumentation to count the work in, or None.
+
+        for suffix in self.__solveSuffixes( letters, unreduced_keys,
+                                            start, deadline, words_left,
+                                            lengths, len(so_far), run ):
+            yield so_far + list(suffix)
+
+    def __reduceKeys(self, letters, unreduced_keys, start, words_left):
+        '''Returns the keys from unreduced_keys[start:] that can still
+        be used with the remaining letters and words.'''
+        if words_left == 0:
+            return []
+        if words_left == 1:
+            # The last word has to use up all of the letters.
+            index = bisect.bisect_left( unreduced_keys, letters, start )
+            if index < len(unreduced_keys) and unreduced_keys[index] == letters:
+                return [ letters ]
+            return []
+        return [ x for x in unreduced_keys[start:] if letters % x == 0 ]
+
+    def __solveSuffixes(self, letters, unreduced_keys, start, deadline,
+                        words_left, lengths, depth, run):
+        '''Yields, as tuples, the ways to finish an anagram from
+        letters using keys from unreduced_keys[start:]. This is
+        where __solveAnagramPhrase does its work; depth is the
+        number of keys already picked.'''
 
         if letters == 1:
             # There are no letters left.
-            if display_progress:
-                print "Result: %s - %s" % \
-                    ( repr(so_far),
-                    self.formulateAnagramPhraseCombo(so_far) )
-            return [ so_far ]
+            yield ()
+            return
+
+        if deadline is not None and time.monotonic() > deadline:
+            return
+
+        if start >= len(unreduced_keys):
+            return
+
+        # Every key from unreduced_keys[start] on that could be used
+        # is in unreduced_keys, so the answer depends only on the
+        # letters and on that first key (and on the constraints).
+        # The same subproblem comes up in many branches; look for it
+        # in the memo first.
+        memo = self.__memo
+        memo_key = ( letters, unreduced_keys[start], words_left, lengths )
+        rows = None
+        if memo is not None:
+            rows = memo.get( memo_key )
+            if rows is not None:
+                memo.move_to_end( memo_key )
+                if run is not None:
+                    run.memo_hits += 1
+                yield from rows
+                return
+            rows = []
 
         # Filter list of keys to remove any that can no longer
         # be constructed using some of the input letters.
-        reduced_keys = [ x for x in unreduced_keys[start:] if letters % x == 0 ]
-        result = []
+        reduced_keys = self.__reduceKeys( letters, unreduced_keys, start, words_left )
+        if words_left is not None:
+            words_left -= 1
+        if run is not None:
+            run.visitNode( depth, len(unreduced_keys) - start, len(reduced_keys) )
 
         # Recurse on all items remaining in the dictionary.
         for index,sig in enumerate(reduced_keys):
-            remaining_letters = letters // sig
-            result += self.__solveAnagramPhrase(
-                    letters        = remaining_letters,
-                    unreduced_keys    = reduced_keys,
-                    start         = index,
-                    so_far        = so_far + [ sig ],
-                    display_progress= display_progress
+            for suffix in self.__solveSuffixes( letters // sig, reduced_keys,
+                                                index, deadline, words_left,
+                                                lengths, depth + 1, run ):
+                row = ( sig, ) + suffix
+                if rows is not None:
+                    rows.append( row )
+                    if len(rows) > MEMO_MAX_ROWS:
+                        rows = None    # Too big to be worth keeping.
+                yield row
+
+        # A subtree cut short by the deadline is not complete, so it
+        # must not be remembered.
+        if memo is not None and rows is not None and \
+                ( deadline is None or time.monotonic() <= deadline ):
+            memo[ memo_key ] = tuple(rows)
+            if len(memo) > self.memo_size:
+                memo.popitem( last=False )
+
+    def __countAnagrams(self, letters, unreduced_keys, start, words_left,
+                        counted, depth=0, run=None):
+        '''Returns the number of anagrams __solveAnagramPhrase would
+        produce for the same arguments, without producing them.
+        counted holds the answers already worked out, keyed the
+        same way as the memo.'''
+        if letters == 1:
+            return 1
+        if start >= len(unreduced_keys):
+            return 0
+        memo_key = ( letters, unreduced_keys[start], words_left )
+        total = counted.get( memo_key )
+        if total is None:
+            reduced_keys = self.__reduceKeys( letters, unreduced_keys, start, words_left )
+            if words_left is not None:
+                words_left -= 1
+            if run is not None:
+                run.visitNode( depth, len(unreduced_keys) - start, len(reduced_keys) )
+            total = 0
+            for index,sig in enumerate(reduced_keys):
+                total += self.__countAnagrams( letters // sig, reduced_keys,
+                                               index, words_left, counted,
+                                               depth + 1, run )
+            counted[ memo_key ] = total
+        elif run is not None:
+            run.memo_hits += 1
+        return total
+
+
+    def __solveAnagramCounts(self, remaining, counts, keys, start=0, \
+                so_far=[], deadline=None, words_left=None, lengths=(1, None),
+                run=None):
+        '''The "counts" engine's version of __solveAnagramPhrase.
+        It walks the keys in the same order, so it finds the
+        same anagrams in the same order. It should not be
+        called directly.'''
+
+        # remaining: Letter counts still to be used, as a numpy
+        #    vector of 26 counts.
+        # counts: numpy matrix with the letter counts of each of
+        #    the keys that are still candidates, one row per key.
+        #    Each level passes down just the rows that fit, so
+        #    the matrix shrinks along with the key list.
+        # keys: The signatures of the rows of counts.
+        # start, so_far, deadline, words_left, lengths, run: As for
+        #    __solveAnagramPhrase.
+
+        if not remaining.any():
+            # There are no letters left.
+            yield so_far
+            return
+
+        if deadline is not None and time.monotonic() > deadline:
+            return
+
+        # With only a few candidates (or words) left, the fixed cost
+        # of a numpy call is more than the big int divisions it
+        # saves, so finish the subtree with the primes engine.
+        if len(keys) - start < COUNTS_MIN_ROWS or \
+                ( words_left is not None and words_left <= 1 ):
+            letters = 1
+            for prime,count in zip( self.chars_list, remaining.tolist() ):
+                letters *= prime ** count
+            yield from self.__solveAnagramPhrase(
+                    letters         = letters,
+                    unreduced_keys  = keys,
+                    start           = start,
+                    so_far          = so_far,
+                    deadline        = deadline,
+                    words_left      = words_left,
+                    lengths         = lengths,
+                    run             = run
                     )
+            return
+
+        # Keep the keys whose letters all fit in what is left,
+        # checking every candidate in one vectorized test.
+        candidates = counts[start:]
+        fits = ( candidates <= remaining ).all( axis=1 )
+        reduced_counts = candidates[fits]
+        reduced_keys = [ k for k,f in zip( keys[start:], fits.tolist() ) if f ]
+        if words_left is not None:
+            words_left -= 1
+        if run is not None:
+            run.visitNode( len(so_far), len(keys) - start, len(reduced_keys) )
 
-        return result
+        for index,sig in enumerate(reduced_keys):
+            yield from self.__solveAnagramCounts(
+                    remaining       = remaining - reduced_counts[index],
+                    counts          = reduced_counts,
+                    keys            = reduced_keys,
+                    start           = index,
+                    so_far          = so_far + [ sig ],
+                    deadline        = deadline,
+                    words_left      = words_left,
+                    lengths         = lengths,
+                    run             = run
+                    )
 
 
-    def anagrams( self, phrase_string, display_progress=False ):
+    def __splitBranches(self, letters, keys, words_left, levels=MAX_SPLIT_DEPTH):
+        '''Break the search for letters into independent branches,
+        in the order the serial search would visit them. Each
+        branch is (letters, so_far, first_key, words_left): the
+        letters still to use, the keys already picked, the smallest
+        key that may be picked next and how many more may be picked.
+        Branches are split a level deeper (up to levels deep) while
+        there are too few of them to keep all the jobs busy.'''
+        branches = [ ( letters, [], keys[0] if keys else 1, words_left ) ]
+        for depth in range(levels):
+            if len(branches) >= self.jobs * BRANCHES_PER_JOB:
+                break
+            split = []
+            for letters,so_far,first_key,words_left in branches:
+                if letters == 1:
+                    split.append( ( letters, so_far, first_key, words_left ) )
+                    continue
+                first = bisect.bisect_left( keys, first_key )
+                for sig in self.__reduceKeys( letters, keys, first, words_left ):
+                    split.append( ( letters // sig, so_far + [ sig ], sig,
+                                    None if words_left is None else words_left - 1 ) )
+            branches = split
+        return branches
+
+    def _solveBranch(self, letters, so_far, first_key, words_left, lengths,
+                     deadline=None):
+        '''Return a list of the anagrams in one branch made by
+        __splitBranches, as lists of keys, and the Instrumentation
+        of the work. This runs in the worker processes.'''
+        run = Instrumentation( 'branch' )
+        found = self.__iterBranch( letters, so_far, first_key, words_left,
+                                   lengths, deadline, run )
+        return list(found), run
+
+    def __iterBranch(self, letters, so_far, first_key, words_left, lengths,
+                     deadline, run):
+        '''Yield the anagrams in one branch made by __splitBranches,
+        as lists of keys.'''
+        keys = self.__getSignatureKeys( lengths )
+        first = bisect.bisect_left( keys, first_key )
+        if self.engine == 'counts':
+            found = self.__solveAnagramCounts(
+                    numpy.array( self.__getCountsFromSignature(letters),
+                                 dtype=numpy.int16 ),
+                    self.__getKeyCounts( lengths ),
+                    keys,
+                    start=first,
+                    so_far=so_far,
+                    deadline=deadline,
+                    words_left=words_left,
+                    lengths=lengths,
+                    run=run )
+        else:
+            found = self.__solveAnagramPhrase(
+                    letters,
+                    keys,
+                    start=first,
+                    so_far=so_far,
+                    deadline=deadline,
+                    words_left=words_left,
+                    lengths=lengths,
+                    run=run )
+        return found
+
+    def __solveBranches(self, letters, words_left, lengths, deadline, run,
+                        progress):
+        '''Yield the anagrams of letters, as lists of keys, one top
+        level branch at a time so that progress can be reported.'''
+        branches = self.__splitBranches( letters,
+                                         self.__getSignatureKeys( lengths ),
+                                         words_left, levels=1 )
+        progress( 0, total=len(branches) )
+        for branch in branches:
+            yield from self.__iterBranch( *branch, lengths=lengths,
+                                          deadline=deadline, run=run )
+            progress()
+
+    def __solveParallel(self, letters, words_left, lengths, deadline, run,
+                        progress=None):
+        '''Yield the anagrams of letters, as lists of keys, using
+        a pool of self.jobs processes. The generator is handed to
+        each process once, when it starts, rather than with every
+        branch. The work the processes do is added to run.'''
+        branches = self.__splitBranches( letters,
+                                         self.__getSignatureKeys( lengths ),
+                                         words_left )
+        run.addPhase( 'Split into %d branches' % (len(branches),) )
+        if progress is not None:
+            progress( 0, total=len(branches) )
+        pool = multiprocessing.Pool( self.jobs, _init_worker, (self,) )
+        try:
+            tasks = [ branch + ( lengths, deadline, ) for branch in branches ]
+            for rows,branch_run in pool.imap( _solve_branch, tasks ):
+                run.merge( branch_run )
+                yield from rows
+                if progress is not None:
+                    progress()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __applyConstraints(self, phrase_string, min_length, max_length,
+                           max_words, required):
+        '''Works out where the search for phrase_string starts under
+        the given constraints. Returns (letters, lengths, words_left)
+        for the part of the phrase left once the required words are
+        taken out, or None if no anagram can meet the constraints.'''
+        letters = self.__getSignature( phrase_string )
+        for word in required:
+            sig = self.__getSignature( word )
+            if letters % sig != 0:
+                return None
+            letters //= sig
+        words_left = None
+        if max_words is not None:
+            words_left = max_words - len(required)
+            if words_left < 0:
+                return None
+        return ( letters, ( min_length, max_length ), words_left )
+
+    def iter_anagrams( self, phrase_string, limit=None, timeout=None,
+                       min_length=1, max_length=None, max_words=None,
+                       required=(), progress=None ):
+        '''Generator version of anagrams(). Each anagram is
+        yielded (in the same form as an element of the list that
+        anagrams() returns) as soon as it is found, so the first
+        results show up right away and nothing is kept around.
+        At most limit anagrams are produced, and the search
+        stops once timeout seconds have passed, if they are given.
+        The rest of the arguments limit which anagrams are wanted,
+        and branches that cannot meet them are not searched:
+        only words of min_length to max_length letters are used,
+        an anagram has at most max_words words, and every word in
+        required is in it. The required words are taken out of the
+        phrase up front and come first in each anagram, whether or
+        not they are in the dictionary.
+        progress, if given, is called as progress(0, total=n) once
+        the search has been split into n branches, and as
+        progress() as each is finished; a progress.Progress can be
+        passed. The work done is measured in self.last_run.'''
+        run = Instrumentation( phrase_string )
+        self.last_run = run
+        start = self.__applyConstraints( phrase_string, min_length, max_length,
+                                         max_words, required )
+        if start is None:
+            run.addPhase( 'No anagram can meet the constraints' )
+            return
+        letters,lengths,words_left = start
+        keys = self.__getSignatureKeys( lengths )
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if self.jobs > 1:
+            found = self.__solveParallel( letters, words_left, lengths, deadline, run,
+                                          progress )
+        elif progress is not None:
+            found = self.__solveBranches( letters, words_left, lengths, deadline, run,
+                                          progress )
+        elif self.engine == 'counts':
+            found = self.__solveAnagramCounts(
+                    numpy.array( self.__getCountsFromSignature(letters),
+                                 dtype=numpy.int16 ),
+                    self.__getKeyCounts( lengths ),
+                    keys,
+                    deadline=deadline,
+                    words_left=words_left,
+                    lengths=lengths,
+                    run=run )
+        else:
+            found = self.__solveAnagramPhrase(
+                    letters,
+                    keys,
+                    deadline=deadline,
+                    words_left=words_left,
+                    lengths=lengths,
+                    run=run )
+
+        prefix = [ [ word ] for word in required ]
+        try:
+            for count,row in enumerate(found):
+                if limit is not None and count >= limit:
+                    break
+                run.rows += 1
+                yield prefix + [ self.sigs[s] for s in row ]
+        finally:
+            found.close()
+            run.addPhase( 'Solve anagrams for "%s": %d rows' % (phrase_string, run.rows,) )
+
+
+    def count_anagrams( self, phrase_string, min_length=1, max_length=None,
+                        max_words=None, required=() ):
+        '''Returns the number of anagrams anagrams() would return
+        for phrase_string. Nothing is enumerated: each subproblem
+        is counted once and its count reused, so this is cheap
+        even for phrases with millions of anagrams. The
+        constraints are as for iter_anagrams(), and the work done
+        is measured in self.last_run as well.'''
+        run = Instrumentation( phrase_string )
+        self.last_run = run
+        start = self.__applyConstraints( phrase_string, min_length, max_length,
+                                         max_words, required )
+        if start is not None:
+            letters,lengths,words_left = start
+            run.rows = self.__countAnagrams( letters, self.__getSignatureKeys(lengths),
+                                             0, words_left, dict(), 0, run )
+        run.addPhase( 'Count anagrams for "%s": %d rows' % (phrase_string, run.rows,) )
+        return run.rows
+
+    def anagrams( self, phrase_string, display_progress=False, **constraints ):
         '''This function takes an input phrase string and returns
         a list of all anagrams that can be generated from it. The
         return value is a list of lists of lists. The inner lists
@@ -248,23 +848,255 @@ class AnagramGenerator:
           [ ['elm','Mel'], ['jar'], ['buck'] ]
           ...
           ]
+        If display_progress is true, each anagram is also printed
+        as it is found. Any other keyword arguments are constraints
+        as for iter_anagrams().
         '''
-        all_keys = self.__getSignatureKeys()
-        if options.dumpdict:
-            for k,v in sorted(sigs.items(), key=lambda x: x[0]):
-                print repr(k),'->',repr(v)
-
-        r = self.__solveAnagramPhrase(
-                self.__getSignature(phrase_string),
-                all_keys,
-                display_progress=display_progress )
-
-        r = [ [ self.sigs[s] for s in row ] for row in r ]
-        addTiming( 'Solve anagrams for "%s": %d rows' % (phrase_string, len(r),) )
+        r = []
+        for row in self.iter_anagrams( phrase_string, **constraints ):
+            if display_progress:
+                print( formatAnagram(row) )
+            r.append( row )
         return r
 
 
 
+# The AnagramGenerator used by a worker process of a parallel search.
+_worker_generator = None
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+def _solve_branch(task):
+    return _worker_generator._solveBranch( *task )
+
+
+
+def formatAnagram(row):
+    '''Render an anagram as returned by iter_anagrams() for display.
+    Words are separated by double spaces, and interchangeable words
+    are shown as a comma separated list.'''
+    return "  ".join( [ ','.join(words) for words in row ] )
+
+
+
+
+
+
+def writeAnagrams(ag, phrase, options, out):
+    '''Write the anagrams of phrase to out (a text file object) the
+    way the command line shows them, using the search settings in
+    options (as parsed in __main__). With options.timing nothing is
+    written. Returns the Instrumentation for the phrase.'''
+    constraints = dict( min_length = options.min_length,
+                        max_length = options.max_length,
+                        max_words = options.max_words,
+                        required = options.required )
+    if options.count:
+        count = ag.count_anagrams( phrase, **constraints )
+        if not options.timing:
+            out.write( "%s: %d\n" % (phrase, count,) )
+        return ag.last_run
+    if not options.timing:
+        out.write( "%s:\n" % phrase )
+    bar = None
+    if options.progress:
+        from progress import Progress
+        bar = Progress( label=phrase )
+    for row in ag.iter_anagrams( phrase, options.limit, options.timeout,
+                                 progress=bar, **constraints ):
+        if not options.timing:
+            if bar is not None:
+                # Erase the bar; it is drawn again after the anagram.
+                bar.clear()
+            out.write( formatAnagram(row) + "\n" )
+    if bar is not None:
+        bar.close()
+    return ag.last_run
+
+
+def readPhrases(f):
+    '''Yield the phrases in a stream with one phrase per line,
+    as they arrive. Blank lines are skipped.'''
+    for line in f:
+        phrase = line.strip()
+        if phrase:
+            yield phrase
+
+
+class AnagramRequestHandler(socketserver.StreamRequestHandler):
+    '''Handles one connection to an AnagramServer. The client
+    sends phrases one per line, and gets back for each one the
+    same text the command line would print, followed by an
+    empty line. If the server was started with --time, the answer
+    is the measurements for the phrase as JSON instead.'''
+    def handle(self):
+        out = io.TextIOWrapper( self.wfile, encoding='utf-8' )
+        inp = io.TextIOWrapper( self.rfile, encoding='utf-8' )
+        for phrase in readPhrases( inp ):
+            run = writeAnagrams( self.server.generator, phrase,
+                                 self.server.options, out )
+            if self.server.options.timing:
+                out.write( json.dumps( run.asDict() ) + "\n" )
+            out.write( "\n" )
+            out.flush()
+
+
+class AnagramServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    '''Serves anagrams on a Unix socket from one AnagramGenerator,
+    so that the dictionary is loaded once for any number of
+    requests. Each connection is handled in a forked child, which
+    shares the loaded signatures with the server, so requests
+    run at the same time.'''
+    def __init__(self, path, generator, options):
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError( '%s exists and is not a socket' % path )
+            probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)    # Left behind by an earlier server.
+            else:
+                raise FileExistsError( 'another server is already serving on %s' % path )
+            finally:
+                probe.close()
+        self.generator = generator
+        self.options = options
+        socketserver.UnixStreamServer.__init__( self, path, AnagramRequestHandler )
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+
+class TestAnagrams(unittest.TestCase):
+    '''Checks that the ways of searching all agree with a plain
+    search: one process, the "primes" engine and no memo.'''
+
+    WORDS = '''a an as at am my no on so to or ton not nor son man
+    may any ray tray story storm moon moan roam sty toy yam mat tam ram
+    arm mar rot tor sot oat taro rota torn morn norm nosy rosy mayo tony
+    stony army many nay yarn snot tons moans snort stormy astronomy
+    Mary Tony Sam Ty'''.split()
+
+    PHRASES = [ 'astronomy', 'stormy moon', 'Tony Mary', 'oat as yam ram'
+              , 'xyz', '' ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.dictionary = os.path.join(self.root, 'words')
+        with open(self.dictionary, 'w') as f:
+            f.write( '\n'.join(self.WORDS) + '\n' )
+
+    def generator(self, **kwargs):
+        return AnagramGenerator( self.dictionary, False, **kwargs )
+
+    def reference(self, phrase, **constraints):
+        return self.generator(memo_size=0).anagrams(phrase, **constraints)
+
+    def test_reference(self):
+        rows = self.reference('Tony Mary')
+        self.assertIn( [ ['tony', 'Tony'], ['army', 'Mary'] ], rows )
+        for row in rows:
+            self.assertEqual( sorted('tonymary')
+                            , sorted(''.join( x[0] for x in row ).lower()) )
+        self.assertEqual([], self.reference('xyz'))
+
+    def test_memo(self):
+        # The memo is shared between phrases and constraints, so each
+        # generator solves all of them in turn. Small limits exercise
+        # eviction and the cap on remembered rows.
+        cases = [ dict(), dict(max_words=2), dict(max_words=4)
+                , dict(min_length=3), dict(max_length=3) ]
+        for memo_size,max_rows in ( (MEMO_SIZE, MEMO_MAX_ROWS), (5, 3) ):
+            with mock.patch( '%s.MEMO_MAX_ROWS' % (__name__,), max_rows ):
+                ag = self.generator(memo_size=memo_size)
+                for _ in range(2):
+                    for phrase in self.PHRASES:
+                        for constraints in cases:
+                            self.assertEqual( self.reference(phrase, **constraints)
+                                            , ag.anagrams(phrase, **constraints) )
+
+    def test_count(self):
+        ag = self.generator()
+        for phrase in self.PHRASES:
+            for constraints in ( dict(), dict(max_words=2), dict(max_words=4)
+                               , dict(min_length=2, max_length=4) ):
+                self.assertEqual( len(self.reference(phrase, **constraints))
+                                , ag.count_anagrams(phrase, **constraints) )
+
+    def test_jobs(self):
+        for jobs in (2, 3):
+            ag = self.generator(jobs=jobs)
+            for phrase in self.PHRASES:
+                self.assertEqual(self.reference(phrase), ag.anagrams(phrase))
+
+    def test_constraints(self):
+        cases = [ dict(min_length=3), dict(max_length=4), dict(max_words=2)
+                , dict(required=['moon']), dict(min_length=3, max_words=3) ]
+        for constraints in cases:
+            full = self.reference('astronomy')
+            rows = self.generator().anagrams('astronomy', **constraints)
+            self.assertEqual( rows, self.reference('astronomy', **constraints) )
+            for row in rows:
+                lengths = [ len(x[0]) for x in row ]
+                self.assertTrue( min(lengths) >= constraints.get('min_length', 1) )
+                self.assertTrue( max(lengths) <= constraints.get('max_length', 99) )
+                self.assertTrue( len(row) <= constraints.get('max_words', 99) )
+            if 'required' not in constraints:
+                self.assertEqual( [ x for x in full if x in rows ], rows )
+
+    def test_limit_and_timeout(self):
+        full = self.reference('astronomy')
+        ag = self.generator()
+        self.assertEqual( full[:3], list(ag.iter_anagrams('astronomy', limit=3)) )
+        # A search cut short yields some of the anagrams, in order, and
+        # leaves nothing half done in the memo. The clock ticks once per
+        # look, so the deadline passes at different points of the search.
+        for timeout in range(0, 400, 7):
+            ag = self.generator()
+            clock = mock.Mock( wraps=time, monotonic=itertools.count().__next__ )
+            with mock.patch( '%s.time' % (__name__,), clock ):
+                cut = list(ag.iter_anagrams('astronomy', timeout=timeout))
+            self.assertEqual( [ x for x in full if x in cut ], cut )
+            self.assertEqual(full, ag.anagrams('astronomy'))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_counts_engine(self):
+        # The dictionary is small, so lower the point at which the counts
+        # engine hands over to the primes engine to have it do some work.
+        for min_rows in (0, 5, 20):
+            with mock.patch( '%s.COUNTS_MIN_ROWS' % (__name__,), min_rows ):
+                ag = self.generator(engine='counts')
+                for phrase in self.PHRASES:
+                    self.assertEqual( self.reference(phrase)
+                                    , ag.anagrams(phrase) )
+                self.assertEqual( self.reference('stormy moon', max_words=2)
+                                , ag.anagrams('stormy moon', max_words=2) )
+
+    def test_cache(self):
+        # A corrupt cache is rebuilt rather than being an error.
+        ag = AnagramGenerator( self.dictionary, True )
+        expected = ag.anagrams('astronomy')
+        filename = self.dictionary + CACHE_SUFFIX
+        with open(filename, 'rb') as f:
+            header = pickle.load(f)
+        for body in ( b'garbage', pickle.dumps( ( [ 1 ], [], [] ) )
+                    , pickle.dumps( ( 'x', 'y' ) ) ):
+            with open(filename, 'wb') as f:
+                pickle.dump(header, f)
+                f.write(body)
+            ag = AnagramGenerator( self.dictionary, True )
+            self.assertEqual(expected, ag.anagrams('astronomy'))
 
 
 
@@ -283,10 +1115,49 @@ separate the phrases with (escaped) semicolons.
                 usage='usage: %prog [options] args',
                 description=description )
     parser.add_option('-t', '--time', action='store_true', default=False,
-            dest='timing', help='Display timing information but not anagrams generated.')
+            dest='timing', help='Print measurements of the loading and of each phrase as JSON instead of the anagrams.')
     parser.add_option('-d', '--dictionary', default='words',
             dest='dictionary_name',
             help='Specify a location for the dictionary. Default is "%default".')
+    parser.add_option('-e', '--engine', type='choice', choices=ENGINES,
+            default='primes', dest='engine',
+            help='Search engine to use: %s. "counts" needs numpy. Default is "%%default".' % ', '.join(ENGINES))
+    parser.add_option('-j', '--jobs', type='int', default=1,
+            dest='jobs',
+            help='Number of processes to search with. Default is %default.')
+    parser.add_option('-l', '--limit', type='int', default=None,
+            dest='limit',
+            help='Stop after this many anagrams of each phrase.')
+    parser.add_option('--timeout', type='float', default=None,
+            dest='timeout',
+            help='Stop searching a phrase after this many seconds.')
+    parser.add_option('--min-length', type='int', default=1,
+            dest='min_length',
+            help='Only use words with at least this many letters. Default is %default.')
+    parser.add_option('--max-length', type='int', default=None,
+            dest='max_length',
+            help='Only use words with at most this many letters.')
+    parser.add_option('-w', '--max-words', type='int', default=None,
+            dest='max_words',
+            help='Only find anagrams with at most this many words.')
+    parser.add_option('-r', '--require', action='append', default=[],
+            dest='required', metavar='WORD',
+            help='Only find anagrams that use WORD. Can be repeated.')
+    parser.add_option('-c', '--count', action='store_true', default=False,
+            dest='count',
+            help='Only print how many anagrams each phrase has.')
+    parser.add_option('-p', '--progress', action='store_true', default=False,
+            dest='progress',
+            help='Show how far through the search of each phrase is, on stderr.')
+    parser.add_option('-b', '--batch', default=None,
+            dest='batch', metavar='FILE',
+            help='Read phrases from FILE, one per line, as well as or instead of the command line. Use "-" for stdin. Lines are handled as they are read.')
+    parser.add_option('--serve', default=None,
+            dest='serve', metavar='PATH',
+            help='Keep the dictionary loaded and answer requests on a Unix socket at PATH. Clients send phrases one per line (try "nc -U PATH"); each answer ends with an empty line.')
+    parser.add_option('--nocache', action='store_true', default=False,
+            dest='nocache',
+            help='Do not read or write the compiled signature cache kept next to the dictionary.')
     parser.add_option('--dumpdict', action='store_true', default=False,
             dest='dumpdict',
             help='Dump dictionary after load, for debug purposes.')
@@ -295,19 +1166,50 @@ separate the phrases with (escaped) semicolons.
 
     if len(test) >= 1:
         test = ' '.join(test).split(';')
+    elif options.batch or options.serve:
+        test = []
     else:
         test = [ "face", "astronomy", "SETEC Astronomy" ]
 
-    ag = AnagramGenerator( options.dictionary_name )
+    ag = AnagramGenerator( options.dictionary_name, not options.nocache,
+                           options.engine, options.jobs )
+    if options.dumpdict:
+        for k,v in sorted(ag.sigs.items(), key=lambda x: x[0]):
+            print(repr(k),'->',repr(v))
+
+    runs = []
     for x in test:
-        print "%s:" % x
-        ag.anagrams( x, not options.timing )
+        runs.append( writeAnagrams( ag, x, options, sys.stdout ) )
+
+    if options.batch == '-':
+        for x in readPhrases( sys.stdin ):
+            runs.append( writeAnagrams( ag, x, options, sys.stdout ) )
+            sys.stdout.flush()
+    elif options.batch:
+        with open( options.batch ) as f:
+            for x in readPhrases( f ):
+                runs.append( writeAnagrams( ag, x, options, sys.stdout ) )
+                sys.stdout.flush()
+
+    if options.serve:
+        try:
+            server = AnagramServer( options.serve, ag, options )
+        except FileExistsError as e:
+            parser.error( str(e) )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
 
     if options.timing:
-        print "Timings:"
-        for et,desc in timings:
-            print "%f - %s" % (et, desc,)
-    print "Done.\n"
+        json.dump( { 'load' : ag.load_stats.asDict(),
+                     'runs' : [ run.asDict() for run in runs ] },
+                   sys.stdout, indent=1 )
+        print()
+    else:
+        print("Done.\n")
 
 
 # 932 seconds to solve SETEC Astronomy without limiting dictionary.
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+#Copyright 2026 Mark Santesson
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import json
+import time
+
+import anagrams
+
+
+''' Benchmarks for anagrams.py. A fixed set of phrases is solved with each
+engine, and the time taken is reported along with the solver's own counts
+of the work it did, so that changes to the solver show up as numbers that
+can be compared between runs.
+'''
+
+
+# The phrases solved, from trivial to a few seconds with a full dictionary.
+PHRASES = [ 'face'
+          , 'astronomy'
+          , 'lumberjack'
+          , 'Mark Santesson'
+          , 'SETEC Astronomy'
+          ]
+
+
+def bench_one(options, engine, phrase):
+    '''Solves phrase with one engine. A fresh AnagramGenerator is used for
+    each run so that nothing is remembered from earlier ones, and the
+    fastest of options.repeat runs is kept.'''
+    best = None
+    for _ in range(options.repeat):
+        ag = anagrams.AnagramGenerator( options.dictionary, True, engine
+                                      , options.jobs )
+        start = time.perf_counter()
+        if options.count:
+            ag.count_anagrams(phrase)
+        else:
+            for row in ag.iter_anagrams(phrase):
+                pass
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = ( seconds, ag.last_run )
+
+    seconds,run = best
+    return { 'engine'          : engine
+           , 'phrase'          : phrase
+           , 'seconds'         : seconds
+           , 'rows'            : run.rows
+           , 'nodes'           : run.nodes
+           , 'memo_hits'       : run.memo_hits
+           , 'peak_candidates' : run.peak_candidates
+           , 'keys_kept'       : run.kept
+           }
+
+
+def _report(row):
+    print( '%-7s %-20s %9.3fs %9d rows %9d nodes %9d memo hits %6d peak' %
+           ( row['engine'], row['phrase'], row['seconds'], row['rows']
+           , row['nodes'], row['memo_hits'], row['peak_candidates'] ) )
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+                usage='%prog [options]',
+                description='Benchmark the anagrams.py solver over a fixed'
+                            ' set of phrases.')
+    parser.add_option( '-d', '--dictionary', dest='dictionary'
+                     , default='words'
+                     , help='Dictionary to load. Default is "%default".' )
+    parser.add_option( '--phrase', dest='phrases', action='append'
+                     , default=None
+                     , help='Solve this phrase instead of the fixed set.'
+                            ' Can be repeated.' )
+    parser.add_option( '-e', '--engine', dest='engines', action='append'
+                     , default=None, choices=anagrams.ENGINES, type='choice'
+                     , help='Only benchmark this engine (%s). Can be'
+                            ' repeated. Default is every engine that can'
+                            ' run here.' % ', '.join(anagrams.ENGINES) )
+    parser.add_option( '-j', '--jobs', dest='jobs', type='int', default=1
+                     , help='Processes to search with. Default is %default.' )
+    parser.add_option( '-c', '--count', dest='count', action='store_true'
+                     , default=False
+                     , help='Time counting the anagrams instead of'
+                            ' producing them.' )
+    parser.add_option( '--repeat', dest='repeat', type='int', default=3
+                     , help='Runs per measurement; the fastest is kept.'
+                            ' Default is %default.' )
+    parser.add_option( '--json', dest='json', default=None, metavar='FILE'
+                     , help='Also write the results to FILE as JSON.' )
+
+    options, args = parser.parse_args()
+
+    engines = options.engines
+    if engines is None:
+        engines = [ e for e in anagrams.ENGINES
+                      if e != 'counts' or anagrams.numpy is not None ]
+
+    rows = list()
+    for engine in engines:
+        for phrase in options.phrases or PHRASES:
+            row = bench_one(options, engine, phrase)
+            _report(row)
+            rows.append(row)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump( { 'dictionary' : options.dictionary
+                       , 'jobs'       : options.jobs
+                       , 'count'      : options.count
+                       , 'results'    : rows }
+                     , f, indent=1, sort_keys=True )
+
+
+if __name__ == '__main__':
+    main()
@@ -14,14 +14,19 @@
 
 
 from __future__ import with_statement
+import fnmatch
 import glob
+import io
+import itertools
 import logging
-import mock
 import os
+import pickle
 import re
-import stat
+import shutil
 import sys
+import tempfile
 import unittest
+from unittest import mock
 
 
 ''' I'm tired of not having grep. When I need it I never need it enough
@@ -34,12 +39,107 @@ def _process(options, args):
     '''Returns a list of results. Each result is a tuple of (filename,
     line index (starting at 0), and the line from the file that matched).
     '''
-    if len(args) < 2:
+    return list(_iter_process(options, args))
+
+
+def _iter_process(options, args):
+    '''Same as _process, but yields each result as soon as it is found
+    instead of collecting them all first. Results come out in the order
+    the files are visited.
+    '''
+    if options and (options.patterns or options.pattern_file):
+        patterns = _option_patterns(options)
+    else:
+        if len(args) < 2:
+            raise Exception('Did not provide enough arguments.')
+        patterns,args = args[:1],args[1:]
+    if not args:
         raise Exception('Did not provide enough arguments.')
-    expr,fileargs = args[0],args[1:]
+    fileargs = args
+
+    search_re = _compile_patterns(options, patterns)
+    searcher = _Searcher(options, search_re, patterns)
+    filepaths = _iter_files(options, fileargs)
+    if options.index:
+        filepaths = _TrigramIndex(options.index).filter(filepaths, search_re)
+
+    if options.jobs > 1:
+        search = lambda bar: _search_parallel(options, searcher, filepaths, bar)
+    else:
+        search = lambda bar: _search_serial(searcher, filepaths, bar)
+    if options.progress:
+        return _with_progress(search)
+    return search(None)
+
+
+def _option_patterns(options):
+    '''Returns the patterns given with -e and -f, in that order.'''
+    patterns = list(options.patterns or [])
+    if options.pattern_file:
+        with open(options.pattern_file) as f:
+            patterns.extend( x for x in f.read().splitlines() if x )
+    return patterns
+
+
+# Back references and conditional groups refer to groups by number, and the
+# numbers shift when patterns are combined into one expression.
+_GROUP_REFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
 
-    search_re = re.compile( expr, re.IGNORECASE if options.ignore_case else 0 )
-    results = list()
+
+def _compile_patterns(options, patterns):
+    '''Combines the patterns into a single compiled expression, so that
+    each file is only read once no matter how many patterns there are.
+    Plain literals are merged into a trie, regular expressions into an
+    alternation.'''
+    flags = re.IGNORECASE if options.ignore_case else 0
+    if not patterns:
+        return re.compile('(?!)')    # An empty -f file matches nothing.
+    if len(patterns) == 1:
+        return re.compile(patterns[0], flags)
+
+    if not any( set(x) & _REGEX_SPECIALS for x in patterns ):
+        return re.compile(_trie_regex(patterns), flags)
+
+    for pattern in patterns[1:]:
+        if _GROUP_REFERENCE_RE.search(pattern):
+            raise Exception( 'Group references can not be used when'
+                             ' combining patterns: {0!r}'.format(pattern) )
+    return re.compile( '|'.join( '(?:%s)' % x for x in patterns ), flags )
+
+
+def _trie_regex(words):
+    '''Returns a regular expression that matches any of the words. It is
+    shaped like a trie: words that share a prefix share the part of the
+    expression that matches it, so the regex engine walks each prefix once
+    instead of once per word, the way an Aho-Corasick automaton would.
+    Longer words are preferred over their own prefixes.'''
+    trie = dict()
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, dict())
+        node[''] = None     # A word ends here.
+
+    def build(node):
+        branches = [ re.escape(ch) + build(child)
+                     for ch,child in sorted(node.items()) if ch ]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            expr = branches[0]
+        else:
+            expr = '(?:%s)' % '|'.join(branches)
+        if '' in node:
+            # Words can stop here too, but try the longer ones first.
+            expr = '(?:%s)?' % expr
+        return expr
+
+    return build(trie)
+
+
+def _iter_files(options, fileargs):
+    '''Yields the path of every file that should be searched, each one
+    only once.'''
     already_hit = set()
 
     for arg in fileargs:
@@ -49,70 +149,651 @@ def _process(options, args):
 
         direct_part,name_part = os.path.split(arg)
 
-        for dir_name in glob.glob(direct_part):
+        # A bare file name means the current directory.
+        dir_names = glob.glob(direct_part) if direct_part else [ '' ]
+
+        for dir_name in dir_names:
 
-            results += _process_recurse( options, search_re
-                                       , dir_name, name_part
-                                       , already_hit )
+            for filepath in _process_recurse( options
+                                            , dir_name, name_part
+                                            , already_hit ):
+                yield filepath
 
-    return results
 
+def _process_recurse(options, direct, name, already_hit, ignores=()):
+    '''Yields the files in direct that match the glob in name, and then
+    (if recursing) the ones in its subdirectories. Each directory is read
+    once with os.scandir, and the type information cached in its entries
+    is used instead of stat-ing every path again.
 
-def _process_recurse(options, search_re, direct, name, already_hit):
+    ignores holds an (_IgnoreFile, path from its directory to direct) pair
+    for each ignore file found on the way down.'''
     if (direct, name) in already_hit:
-        return []
+        return
     already_hit.add( (direct, name) )
 
-    results = list()
-    entry = os.path.join(direct,name)
-    filepaths = glob.glob(entry)
-    for filepath in filepaths:
+    try:
+        dir_entries = list(os.scandir(direct or '.'))
+    except OSError:
+        return      # Unreadable or vanished directories are skipped.
+
+    if options.recurse and not options.no_ignore:
+        names_here = set( x.name for x in dir_entries )
+        ignores = ignores + tuple(
+                    ( _IgnoreFile(os.path.join(direct, x)), '' )
+                    for x in _IGNORE_FILES if x in names_here )
+
+    # Like glob, wildcards do not match hidden files unless asked to.
+    match_hidden = name.startswith('.')
+
+    subdirs = list()
+    for dir_entry in dir_entries:
+        file_here = dir_entry.name
+        hidden = file_here.startswith('.')
+
+        # If a directory was given, join that with the files here. The
+        # path is built by hand so that it is spelled the way the user
+        # spelled it, symlinks and all.
+        filepath = os.path.join(direct, file_here) if direct else file_here
+
+        try:
+            is_dir = dir_entry.is_dir()
+        except OSError:
+            continue
+
+        if is_dir:
+            # Don't go through .git, &c. Ignored directories are pruned
+            # here, before they are ever listed.
+            if ( options.recurse and not hidden
+                 and not _is_ignored(ignores, file_here, True) ):
+                subdirs.append( (filepath, file_here) )
+            continue    # Silently ignore directories matched by the glob.
+
+        if hidden and not match_hidden:
+            continue
+        if not fnmatch.fnmatch(file_here, name):
+            continue
+        if ignores and _is_ignored(ignores, file_here, False):
+            continue
+
         if filepath in already_hit:
             continue
         already_hit.add(filepath)
 
+        if options.max_filesize is not None:
+            try:
+                if dir_entry.stat().st_size > options.max_filesize:
+                    continue
+            except OSError:
+                pass        # Let the search report it.
+
         if options.verbose:
-            print 'Checking {0}'.format(filepath)
+            print('Checking {0}'.format(filepath))
+
+        yield filepath
+
+    for subdir,subdir_name in subdirs:
+        sub_ignores = tuple( (x, prefix + subdir_name + '/')
+                             for x,prefix in ignores )
+        for filepath in _process_recurse( options
+                                        , subdir, name
+                                        , already_hit, sub_ignores ):
+            yield filepath
+
 
-        if os.stat(filepath).st_mode & stat.S_IFDIR:
-            continue    # Silently ignore directories matched by regex.
+# Files in a directory that list paths under it to leave out of a
+# recursive search.
+_IGNORE_FILES = ( '.gitignore', '.ignore' )
 
-        elif not os.access(filepath, os.R_OK):
-            results.append( (filepath, -1, 'Error: File not readable',) )
 
+def _is_ignored(ignores, name, is_dir):
+    '''Checks name, an entry of the current directory, against the ignore
+    files above it. As with git, the last rule that matches wins, and rules
+    in deeper ignore files come later.'''
+    ignored = False
+    for ignore_file,prefix in ignores:
+        verdict = ignore_file.match(prefix + name, name, is_dir)
+        if verdict is not None:
+            ignored = verdict
+    return ignored
+
+
+def _ignore_glob_regex(pattern):
+    '''Translates a gitignore glob into a regular expression matched
+    against a '/' separated path.'''
+    parts = list()
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            parts.append('/.*')
+            break
+        if ch == '*':
+            parts.append('.*' if pattern.startswith('**', i) else '[^/]*')
+            i += 2 if pattern.startswith('**', i) else 1
+            continue
+        if ch == '?':
+            parts.append('[^/]')
+        elif ch == '[':
+            close = pattern.find(']', i + 2)
+            if close < 0:
+                parts.append(re.escape(ch))
+            else:
+                body = pattern[i+1:close]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append('[%s]' % body.replace('\\', '\\\\'))
+                i = close
+        elif ch == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
         else:
-            lines = open(filepath).readlines()
-            for i,line in enumerate(lines):
-                if search_re.search( line ):
-                    results.append( (filepath, i, line,) )
-
-    if options.recurse:
-        files_here = os.listdir(direct or '.')
-        for file_here in files_here:
-            # Don't go through ., .., .git, &c.
-            if file_here.startswith('.'):
+            parts.append(re.escape(ch))
+        i += 1
+    return re.compile(''.join(parts) + '$', re.DOTALL)
+
+
+class _IgnoreFile(object):
+    '''The rules of one .gitignore style file: blank lines and '#'
+    comments are skipped, '!' re-includes, a trailing '/' only matches
+    directories, and a pattern containing a '/' is anchored to the
+    directory the file is in. Otherwise the pattern matches the name at any
+    depth.'''
+
+    def __init__(self, path):
+        self.rules = list()
+        try:
+            with open(path, errors='replace') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return
+
+        for line in lines:
+            if line.endswith(' ') and not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
                 continue
 
-            # If a directory was given, join that with the files here.
-            if direct:
-                file_here = os.path.join(direct, file_here)
+            negate = line.startswith('!')
+            if negate or line.startswith('\\!') or line.startswith('\\#'):
+                line = line[1:]
 
-            if os.path.isdir(file_here):
-                res = _process_recurse( options, search_re
-                                      , file_here, name
-                                      , already_hit )
-                results += res
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
 
-    return results
+            anchored = '/' in line
+            self.rules.append( ( _ignore_glob_regex(line.lstrip('/'))
+                               , anchored, dir_only, not negate ) )
 
+    def match(self, relpath, name, is_dir):
+        '''Returns True if the path is ignored, False if it was explicitly
+        re-included, and None if no rule is about it.'''
+        verdict = None
+        for rule_re,anchored,dir_only,ignore in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if rule_re.match(relpath if anchored else name):
+                verdict = ignore
+        return verdict
 
-def main():
+
+# Bump this whenever the layout of the index file changes.
+_INDEX_VERSION = 1
+
+# Letters that re.IGNORECASE also matches against non-ASCII characters (the
+# Kelvin sign, the long s, the dotless i). Their trigrams can't be trusted
+# in a case-insensitive search.
+_UNSAFE_FOLDS = frozenset(b'IKSiks')
+
+
+# Largest bloom filter kept for one file, in bits. At this size every
+# possible trigram has a bit of its own.
+_MAX_BLOOM_BITS = 1 << 24
+
+
+def _trigrams(data):
+    return frozenset( data[i:i+3] for i in range(len(data) - 2) )
+
+
+def _bloom_bit(trigram, mask):
+    return ((trigram * 0x9E3779B1) >> 8) & mask
+
+
+def _trigram_bloom(data):
+    '''Returns a bloom filter (as bytes) of the trigrams in data, with about
+    four bits per distinct trigram. Storing the filter instead of the
+    trigrams themselves keeps the index a fraction of the size of the
+    files, at the cost of the odd file being read for nothing.'''
+    trigrams = set(zip(data, data[1:], data[2:]))
+    bits = 64
+    while bits < 4 * len(trigrams) and bits < _MAX_BLOOM_BITS:
+        bits *= 2
+    mask = bits - 1
+    bloom = bytearray(bits // 8)
+    for a,b,c in trigrams:
+        bit = _bloom_bit(a << 16 | b << 8 | c, mask)
+        bloom[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bloom)
+
+
+def _trigram_query(search_re):
+    '''Works out which trigrams any match of search_re has to contain.
+    Returns None if the expression doesn't require any, otherwise a tree of
+    ('and', [...]) and ('or', [...]) nodes whose leaves are sets of
+    lower-cased byte trigrams that all have to be present.'''
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        import sre_parse
+
+    # Inline flags could turn on case folding for part of the pattern.
+    fold = bool(search_re.flags & re.IGNORECASE) or '(?' in search_re.pattern
+    repeats = ( sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT
+              , getattr(sre_parse, 'POSSESSIVE_REPEAT', None) )
+    atomic = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+    def required(items):
+        nodes = list()
+        run = bytearray()
+
+        def flush():
+            if len(run) >= 3:
+                nodes.append(_trigrams(bytes(run).lower()))
+            del run[:]
+
+        for op,av in items:
+            if ( op is sre_parse.LITERAL and av < 128
+                 and not (fold and av in _UNSAFE_FOLDS) ):
+                run.append(av)
+                continue
+            flush()
+
+            node = None
+            if op is sre_parse.SUBPATTERN:
+                node = required(av[-1])
+            elif atomic is not None and op is atomic:
+                node = required(av)
+            elif op in repeats and av[0] >= 1:
+                node = required(av[2])
+            elif op is sre_parse.BRANCH:
+                alternatives = [ required(x) for x in av[1] ]
+                if None not in alternatives:
+                    node = ('or', alternatives)
+            if node is not None:
+                nodes.append(node)
+        flush()
+
+        if not nodes:
+            return None
+        if len(nodes) == 1:
+            return nodes[0]
+        return ('and', nodes)
+
+    return required(sre_parse.parse(search_re.pattern, search_re.flags))
+
+
+def _query_matches(query, bloom):
+    if isinstance(query, frozenset):
+        mask = len(bloom) * 8 - 1
+        for a,b,c in query:
+            bit = _bloom_bit(a << 16 | b << 8 | c, mask)
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+    kind,nodes = query
+    if kind == 'and':
+        return all( _query_matches(x, bloom) for x in nodes )
+    return any( _query_matches(x, bloom) for x in nodes )
+
+
+class _TrigramIndex(object):
+    '''An on-disk record of the trigrams in every file searched so far.
+    Files that don't have the trigrams a match for the expression needs
+    are skipped without being read. Entries are keyed on the absolute path and
+    refreshed whenever the file's mtime or size changes.'''
+
+    FILENAME = 'grep-trigrams.pickle'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILENAME)
+        self.entries = dict()
+        self.changed = False
+
+        try:
+            with open(self.path, 'rb') as f:
+                version,entries = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if version == _INDEX_VERSION:
+            self.entries = entries
+
+    def filter(self, filepaths, search_re):
+        '''Yields the files that could contain a match. If the expression
+        doesn't narrow anything down, every file is passed through and the
+        index is left alone.'''
+        query = _trigram_query(search_re)
+        if query is None:
+            for filepath in filepaths:
+                yield filepath
+            return
+
+        seen = set()
+        try:
+            for filepath in filepaths:
+                key = os.path.abspath(filepath)
+                seen.add(key)
+                bloom = self._bloom_for(key)
+                if bloom is None or _query_matches(query, bloom):
+                    yield filepath
+        finally:
+            self.save(seen)
+
+    def _bloom_for(self, key):
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None     # Let the search report it.
+
+        entry = self.entries.get(key)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            return entry[2]
+
+        try:
+            with open(key, 'rb') as f:
+                bloom = _trigram_bloom(f.read().lower())
+        except (IOError, OSError):
+            return None
+        self.entries[key] = (st.st_mtime_ns, st.st_size, bloom)
+        self.changed = True
+        return bloom
+
+    def save(self, seen=()):
+        '''Writes the index back out if anything changed, dropping entries
+        for files that no longer exist.'''
+        for key in [ x for x in self.entries if x not in seen ]:
+            if not os.path.exists(key):
+                del self.entries[key]
+                self.changed = True
+        if not self.changed:
+            return
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump( (_INDEX_VERSION, self.entries), f
+                       , pickle.HIGHEST_PROTOCOL )
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+def _with_progress(search):
+    '''Passes the results of search(bar) through, with bar a progress bar
+    on stderr that the search counts the files it has searched on.'''
+    from progress import Progress
+
+    with Progress(label='Files searched:') as bar:
+        for result in search(bar):
+            yield result
+
+
+def _search_serial(searcher, filepaths, progress=None):
+    for filepath in filepaths:
+        for result in searcher.search(filepath):
+            yield result
+        if progress is not None:
+            progress()
+
+
+# Number of files handed to a worker process at a time by _search_parallel.
+# Large enough to amortize the interprocess traffic, small enough that the
+# first results still show up quickly.
+_CHUNK_SIZE = 32
+
+_worker_searcher = None
+
+
+def _init_worker(searcher):
+    global _worker_searcher
+    _worker_searcher = searcher
+
+
+def _search_chunk(filepaths):
+    return len(filepaths), [ result for filepath in filepaths
+                                    for result in _worker_searcher.search(filepath) ]
+
+
+def _chunks(iterable, size):
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def _search_parallel(options, searcher, filepaths, progress=None):
+    '''Searches the files with a pool of options.jobs processes. Files
+    are still discovered (and de-duplicated) in this process and handed out
+    in chunks. Results are yielded in discovery order, so the output is the
+    same as for a serial search. progress, if given, is called with the
+    number of files in each chunk as its results come back.'''
+    import multiprocessing
+
+    pool = multiprocessing.Pool(options.jobs, _init_worker, (searcher,))
+    try:
+        for searched,results in pool.imap( _search_chunk
+                                         , _chunks(filepaths, _CHUNK_SIZE) ):
+            if progress is not None:
+                progress(searched)
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Number of bytes at the start of a file that are checked for a NUL when
+# deciding whether it is binary.
+_SNIFF_SIZE = 8192
+
+# Number of characters the buffer engine reads from a file at a time.
+_BLOCK_SIZE = 1 << 20
+
+# Pattern pieces that can behave differently when run over a whole buffer
+# instead of a single line: anchors to the ends of the string, explicit
+# newlines, and lookarounds that could see into the neighboring lines.
+# Patterns containing any of them are always searched line by line.
+_BUFFER_UNSAFE = ( '\\A', '\\Z', '\\n', '\n', '(?<', '(?!', '(?=' )
+
+_REGEX_SPECIALS = frozenset('.^$*+?{}[]\\|()')
+
+
+class _Searcher(object):
+    '''Searches a single file. It is built once from the options and
+    handed to the worker processes when running in parallel, so it only
+    holds picklable state.
+
+    The 'line' engine runs search_re on every line. The 'buffer' engine
+    reads the file in large blocks and runs the search over the whole
+    block, only splitting out a line (and working out its number) when
+    there is a hit in it. Plain literal patterns are found with str.find.
+    Both engines give the same results.'''
+
+    def __init__(self, options, search_re, patterns=None):
+        self.search_re = search_re
+        self.labels = None
+        if patterns and len(patterns) > 1:
+            flags = re.IGNORECASE if options.ignore_case else 0
+            self.labels = [ (x, re.compile(x, flags)) for x in patterns ]
+        self.engine = options.engine
+        self.count = options.count
+        self.binary_files = options.binary_files
+        self.limit = options.max_count
+        if options.files_with_matches:
+            self.limit = 1
+        self.literal = None
+        self.fold_case = False
+
+        pattern = search_re.pattern
+        if any( x in pattern for x in _BUFFER_UNSAFE ):
+            self.engine = 'line'
+        if self.engine != 'buffer':
+            return
+
+        self.buffer_re = re.compile(pattern, search_re.flags | re.MULTILINE)
+
+        if not set(pattern) & _REGEX_SPECIALS:
+            if not options.ignore_case:
+                self.literal = pattern
+            elif pattern.isascii():
+                # str.lower can only be trusted to line up positions, and
+                # to agree with re.IGNORECASE, on ASCII text.
+                self.literal = pattern.lower()
+                self.fold_case = True
+
+    def search(self, filepath):
+        '''Yields a result tuple for every line of the file that
+        matches. When searching for several patterns, the first pattern
+        that matched is added to the end of the tuple. When counting, a
+        single (filename, number of matching lines, None) tuple is yielded
+        instead.'''
+        try:
+            raw = open(filepath, 'rb')
+        except (IOError, OSError):
+            yield (filepath, -1, 'Error: File not readable',)
+            return
+
+        with raw:
+            # A NUL byte near the start is taken to mean a binary file.
+            binary = ( self.binary_files != 'text'
+                       and b'\0' in raw.peek(_SNIFF_SIZE)[:_SNIFF_SIZE] )
+            if binary and self.binary_files == 'skip':
+                return
+            report = binary and not self.count
+
+            f = io.TextIOWrapper(raw, errors='replace')
+            if self.engine == 'buffer':
+                hits = self._search_blocks(f)
+            else:
+                hits = self._search_lines(f)
+
+            # Stop reading the file as soon as enough hits were seen.
+            limit = 1 if report else self.limit
+            if limit is not None:
+                hits = itertools.islice(hits, limit)
+
+            if self.count:
+                yield (filepath, sum( 1 for _ in hits ), None,)
+                return
+
+            for i,line in hits:
+                label = self._label(line) if self.labels else None
+                if report:
+                    line = 'Binary file matches'
+                if self.labels:
+                    yield (filepath, i, line, label,)
+                else:
+                    yield (filepath, i, line,)
+
+    def _label(self, line):
+        '''Returns the first of the patterns that matches the line.'''
+        for pattern,pattern_re in self.labels:
+            if pattern_re.search(line):
+                return pattern
+
+    def _search_lines(self, f):
+        search = self.search_re.search
+        for i,line in enumerate(f):
+            if search( line ):
+                yield i,line
+
+    def _search_blocks(self, f):
+        line_no = 0     # Line number of the start of buf.
+        tail = ''       # Unfinished last line of the previous block.
+        while True:
+            block = f.read(_BLOCK_SIZE)
+            buf = tail + block
+            if block:
+                # Only search complete lines; the rest waits for the next
+                # block.
+                end = buf.rfind('\n') + 1
+                if not end:
+                    tail = buf
+                    continue
+            else:
+                end = len(buf)
+
+            for hit in self._search_buffer(buf, end, line_no):
+                yield hit
+
+            if not block:
+                return
+            line_no += buf.count('\n', 0, end)
+            tail = buf[end:]
+
+    def _search_buffer(self, buf, end, line_no):
+        '''Yields (line index, line) for the lines in buf[:end] that match.
+        line_no is the index of the first line in buf.'''
+        verify = self.search_re.search
+        if self.literal is None:
+            search = self.buffer_re.search
+            def find(pos):
+                match = search(buf, pos, end)
+                return match.start() if match else -1
+        elif not self.fold_case:
+            verify = None
+            find = lambda pos: buf.find(self.literal, pos, end)
+        elif buf.isascii():
+            verify = None
+            lowered = buf.lower()
+            find = lambda pos: lowered.find(self.literal, pos, end)
+        else:
+            search = self.buffer_re.search
+            def find(pos):
+                match = search(buf, pos, end)
+                return match.start() if match else -1
+
+        pos = counted = 0
+        while pos < end:
+            hit = find(pos)
+            if hit < 0:
+                return
+            if hit == end and buf[end-1] == '\n':
+                return      # Empty match after the last line.
+
+            line_start = buf.rfind('\n', pos, hit) + 1 or pos
+            line_end = buf.find('\n', hit, end) + 1 or end
+
+            line_no += buf.count('\n', counted, line_start)
+            counted = line_start
+
+            # The search over the buffer may have matched across lines,
+            # so check the line by itself.
+            line = buf[line_start:line_end]
+            if verify is None or verify(line):
+                yield line_no,line
+
+            pos = line_end
+
+
+def _option_parser():
     import optparse
 
     helptext='''\
 %prog --help
 %prog -u
 %prog expr [options] glob1 [glob2...]
+%prog -e expr1 [-e expr2...] [-f exprfile] [options] glob1 [glob2...]
 This is an approximation of grep, but written in Python so it can be
 moved around.
 '''
@@ -128,23 +809,98 @@ moved around.
                      , default=False, help='Ignore case.' )
     parser.add_option( '-v', dest='verbose', action='store_true'
                      , default=False, help='Verbose mode.' )
+    parser.add_option( '-j', dest='jobs', type='int', default=1
+                     , help='Number of processes to search files with.'
+                            ' Default is %default.' )
+    parser.add_option( '-e', dest='patterns', action='append', default=None
+                     , metavar='PATTERN'
+                     , help='Search for PATTERN. Can be given more than'
+                            ' once to search for several patterns in one'
+                            ' pass; each match then says which pattern'
+                            ' it was. All arguments are then globs.' )
+    parser.add_option( '-f', dest='pattern_file', default=None
+                     , metavar='FILE'
+                     , help='Read patterns to search for from FILE, one'
+                            ' per line, as with -e.' )
+    parser.add_option( '-l', dest='files_with_matches', action='store_true'
+                     , default=False
+                     , help='Only print the names of files that match.'
+                            ' Each file is read only up to its first match.' )
+    parser.add_option( '-c', dest='count', action='store_true'
+                     , default=False
+                     , help='Only print the number of matching lines in'
+                            ' each file.' )
+    parser.add_option( '-m', dest='max_count', type='int', default=None
+                     , metavar='NUM'
+                     , help='Stop reading a file after NUM matching lines.' )
+    parser.add_option( '--binary-files', dest='binary_files', type='choice'
+                     , choices=[ 'report', 'skip', 'text' ]
+                     , default='report'
+                     , help='What to do with files that look binary: "report"'
+                            ' prints one line if the file matches, "skip"'
+                            ' does not search them, "text" searches them'
+                            ' like any other file. Default is "%default".' )
+    parser.add_option( '--max-filesize', dest='max_filesize', type='int'
+                     , default=None, metavar='BYTES'
+                     , help='Skip files larger than BYTES.' )
+    parser.add_option( '--no-ignore', dest='no_ignore', action='store_true'
+                     , default=False
+                     , help='When recursing, do not skip the paths listed'
+                            ' in .gitignore and .ignore files.' )
+    parser.add_option( '--engine', dest='engine', type='choice'
+                     , choices=[ 'line', 'buffer' ], default='line'
+                     , help='How to search each file. "line" runs the'
+                            ' expression on every line, "buffer" runs it'
+                            ' over large blocks of the file at once, which'
+                            ' is faster when matches are rare. Default is'
+                            ' "%default".' )
+    parser.add_option( '--index', dest='index', metavar='DIR', default=None
+                     , help='Keep a trigram index of the searched files in'
+                            ' DIR and use it to skip files that cannot'
+                            ' match. It is created on first use and updated'
+                            ' as files change.' )
+    parser.add_option( '--progress', dest='progress', action='store_true'
+                     , default=False
+                     , help='Show how many files have been searched, and how'
+                            ' fast, on stderr.' )
+    parser.add_option( '-s', '--sort', dest='sort', action='store_true'
+                     , default=False
+                     , help='Sort the results before printing them. Without'
+                            ' this, results are printed as they are found.' )
     parser.add_option( '-u', dest='unittest', action='store_true'
                      , default=False, help='Run unit tests.' )
+    return parser
 
-    options, args = parser.parse_args()
+
+def main():
+    options, args = _option_parser().parse_args()
     if options.unittest:
         suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
         unittest.TextTestRunner().run(suite)
     else:
-        if len(args) < 2:
-            print 'No argument or filenames provided. Use "--help" to get help.'
+        if len(args) < (1 if options.patterns or options.pattern_file else 2):
+            print('No argument or filenames provided. Use "--help" to get help.')
             sys.exit(1)
 
-        results = _process(options, args)
-        results.sort()
+        results = _iter_process(options, args)
+        if options.sort:
+            results = sorted(results)
 
-        print '\n'.join( [ '%s(%d): %s' % (f,i+1,l.strip())
-                           for f,i,l in results ] )
+        for result in results:
+            if options.progress and sys.stderr.isatty():
+                # Erase the bar; it is drawn again after the result.
+                sys.stderr.write('\r\x1b[K')
+            f,i,l = result[:3]
+            if i < 0:
+                print('%s(%d): %s' % (f,i+1,l.strip()))
+            elif options.count:
+                print('%s: %d' % (f,i))
+            elif options.files_with_matches:
+                print(f)
+            elif len(result) > 3:
+                print('%s(%d) [%s]: %s' % (f,i+1,result[3],l.strip()))
+            else:
+                print('%s(%d): %s' % (f,i+1,l.strip()))
 
 
 class TestTesting(unittest.TestCase):
@@ -154,16 +910,42 @@ class TestTesting(unittest.TestCase):
         attribs = dict( recurse     = False
                       , ignore_case = False
                       , verbose     = False
+                      , jobs        = 1
+                      , engine      = 'line'
+                      , index       = None
+                      , files_with_matches = False
+                      , count       = False
+                      , max_count   = None
+                      , patterns    = None
+                      , pattern_file = None
+                      , binary_files = 'report'
+                      , max_filesize = None
+                      , no_ignore   = False
+                      , progress    = False
                       )
         attribs.update(kwargs)
         return mock.Mock(**attribs)
 
+    def make_tree(self, files):
+        '''Creates a temporary directory holding the given {relative path:
+        contents} files and returns its path.'''
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for relpath,contents in files.items():
+            path = os.path.join(root, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        return root
+
     @staticmethod
     def search(search_string, files=None, options=None):
         if files is None:
             files = [ sys.modules[__name__].__file__ ]
-        return _process( options or TestTesting.options()
-                       , [ search_string ] + files)
+        if search_string is not None:
+            files = [ search_string ] + files
+        return _process(options or TestTesting.options(), files)
 
     def test_contains_simple_string(self):
         search_string = r'xyzzy_1'
@@ -233,6 +1015,236 @@ class TestTesting(unittest.TestCase):
         with self.assertRaises(Exception):
             res = _process(None, [ 'dsaduinNosaidaDOA' ])
 
+    def test_streaming(self):
+        search_string = r'xyzzy_7'
+        res = _iter_process( self.options()
+                           , [ search_string, sys.modules[__name__].__file__ ] )
+        self.assertFalse(isinstance(res, list))
+        self.assertIn(search_string, next(res)[2])
+        self.assertEqual([], list(res))
+
+    def test_walk(self):
+        root = self.make_tree({ 'a.txt'             : 'hit\n'
+                              , 'sub/b.txt'         : 'hit\n'
+                              , 'sub/deeper/c.txt'  : 'hit\n'
+                              , 'sub/f.py'          : 'hit\n'
+                              , 'sub/.e.txt'        : 'hit\n'
+                              , '.hidden/d.txt'     : 'hit\n'
+                              })
+        os.symlink(os.path.join(root, 'sub'), os.path.join(root, 'link'))
+
+        res = self.search( 'hit', [ os.path.join(root, '*.txt') ]
+                         , self.options(recurse=True) )
+        found = sorted( os.path.relpath(f, root).replace(os.sep, '/')
+                        for f,i,l in res )
+        self.assertEqual( [ 'a.txt', 'link/b.txt', 'link/deeper/c.txt'
+                          , 'sub/b.txt', 'sub/deeper/c.txt' ]
+                        , found )
+
+        res = self.search( 'hit', [ os.path.join(root, 'sub', '.*') ] )
+        self.assertEqual(1, len(res))
+
+    def test_buffer_engine(self):
+        text = ( 'first line\n\nAlpha beta\nalpha\n  gamma  \n'
+                 'beta\n\u0130stanbul Kelvin \u212a\nlast alpha' )
+        root = self.make_tree({ 'a.txt' : text, 'empty.txt' : '' })
+        files = [ os.path.join(root, '*.txt') ]
+        patterns = [ 'alpha', 'Alpha', 'a', 'beta\\s+alpha', '^$', '^'
+                   , 'a$', '$', '^beta', 'k', 'gamma  $', '', 'line\\n'
+                   , 'alpha\\Z', '[a-z]+ [a-z]+' ]
+
+        for block_size in (5, 1 << 20):
+            with mock.patch.object( sys.modules[__name__], '_BLOCK_SIZE'
+                                  , block_size ):
+                for ignore_case in (False, True):
+                    for pattern in patterns:
+                        self.assertEqual(
+                            self.search( pattern, files
+                                       , self.options(ignore_case=ignore_case) )
+                          , self.search( pattern, files
+                                       , self.options( ignore_case=ignore_case
+                                                     , engine='buffer' ) )
+                          , (pattern, ignore_case, block_size) )
+
+    def test_trigram_query(self):
+        query = lambda expr, flags=0: _trigram_query(re.compile(expr, flags))
+        self.assertEqual(None, query('ab.*cd'))
+        self.assertEqual(frozenset([b'abc', b'bcd']), query('ABcd'))
+        self.assertEqual(None, query('abc|x'))
+        self.assertEqual( ('or', [ frozenset([b'abc']), frozenset([b'xyz']) ])
+                        , query('abc|xyz') )
+        self.assertEqual( ('and', [ frozenset([b'abc']), frozenset([b'xyz']) ])
+                        , query('abc(xyz)+q?') )
+        self.assertEqual(frozenset([b'abc']), query('abcskip', re.IGNORECASE))
+        if sys.version_info >= (3, 11):
+            self.assertEqual( ('and', [ frozenset([b'abc']), frozenset([b'def']) ])
+                            , query('(?>abc)def') )
+
+    def test_index(self):
+        root = self.make_tree({ 'a.txt' : 'one alpha\n'
+                              , 'b.txt' : 'two beta\n'
+                              , 'sub/c.txt' : 'three alpha\n'
+                              })
+        index_dir = os.path.join(root, 'index')
+        files = [ os.path.join(root, '*.txt') ]
+        options = self.options(recurse=True, index=index_dir)
+
+        self.assertEqual(2, len(self.search('alpha', files, options)))
+        self.assertTrue(os.path.exists( os.path.join( index_dir
+                                                    , _TrigramIndex.FILENAME )))
+        self.assertEqual(1, len(self.search('two', files, options)))
+        self.assertEqual(3, len(self.search('e.*', files, options)))
+
+        # Changes to a file are picked up.
+        with open(os.path.join(root, 'b.txt'), 'a') as f:
+            f.write('more alpha\n')
+        self.assertEqual(3, len(self.search('ALPHA', files,
+                self.options(recurse=True, index=index_dir, ignore_case=True))))
+
+        # Deleted files are dropped from the index.
+        os.remove(os.path.join(root, 'sub', 'c.txt'))
+        self.assertEqual(2, len(self.search('alpha', files, options)))
+        self.assertEqual(2, len(_TrigramIndex(index_dir).entries))
+
+    def test_output_modes(self):
+        root = self.make_tree({ 'a.txt' : 'hit 1\nmiss\nhit 2\nhit 3\n'
+                              , 'b.txt' : 'miss\n'
+                              , 'c.txt' : 'hit\n'
+                              })
+        files = [ os.path.join(root, '*.txt') ]
+        name = lambda f: os.path.basename(f)
+
+        for engine in ('line', 'buffer'):
+            res = self.search( 'hit', files
+                             , self.options(engine=engine, max_count=2) )
+            self.assertEqual( [ ('a.txt', 0), ('a.txt', 2), ('c.txt', 0) ]
+                            , sorted( (name(f),i) for f,i,l in res ) )
+
+            res = self.search( 'hit', files
+                             , self.options( engine=engine
+                                           , files_with_matches=True ) )
+            self.assertEqual( [ ('a.txt', 0), ('c.txt', 0) ]
+                            , sorted( (name(f),i) for f,i,l in res ) )
+
+            res = self.search( 'hit', files
+                             , self.options(engine=engine, count=True) )
+            self.assertEqual( [ ('a.txt', 3, None), ('b.txt', 0, None)
+                              , ('c.txt', 1, None) ]
+                            , sorted( (name(f),i,l) for f,i,l in res ) )
+
+    def test_trie_regex(self):
+        words = [ 'abc', 'ab', 'abd', 'x.y', 'b' ]
+        trie_re = re.compile(_trie_regex(words))
+        self.assertEqual('abc', trie_re.search('zabcz').group())
+        self.assertEqual('ab', trie_re.search('zabz').group())
+        self.assertEqual('x.y', trie_re.search('xxy x.y').group())
+        self.assertEqual( sorted( set(words) )
+                        , sorted( x for x in words if trie_re.fullmatch(x) ) )
+        self.assertFalse(trie_re.search('xy a'))
+
+    def test_multiple_patterns(self):
+        root = self.make_tree({ 'a.txt' : 'one alpha\ntwo beta\nthree\n'
+                              , 'patterns' : 'beta\n\nthr+ee\n'
+                              })
+        files = [ os.path.join(root, '*.txt') ]
+
+        for engine in ('line', 'buffer'):
+            res = self.search( None, files
+                             , self.options( engine=engine
+                                           , patterns=['alpha', 'beta'] ) )
+            self.assertEqual( [ (0, 'alpha'), (1, 'beta') ]
+                            , [ (x[1],x[3]) for x in res ] )
+
+            res = self.search( None, files
+                             , self.options( engine=engine
+                                           , patterns=['al+pha']
+                                           , pattern_file=os.path.join( root
+                                                            , 'patterns' ) ) )
+            self.assertEqual( [ (0, 'al+pha'), (1, 'beta'), (2, 'thr+ee') ]
+                            , [ (x[1],x[3]) for x in res ] )
+
+        with self.assertRaises(Exception):
+            self.search(None, files, self.options(patterns=['a', '(b)\\1']))
+
+        # An empty pattern file matches nothing, rather than taking the
+        # first file as the pattern.
+        empty = os.path.join(root, 'empty')
+        open(empty, 'w').close()
+        self.assertEqual( [], self.search( None, files + files
+                                         , self.options(pattern_file=empty) ) )
+
+    def test_binary_files(self):
+        root = self.make_tree({ 'a.txt' : 'hit\n' * 3 })
+        with open(os.path.join(root, 'b.bin'), 'wb') as f:
+            f.write(b'\0\1\2 hit\n' * 3)
+        files = [ os.path.join(root, '*') ]
+
+        res = self.search('hit', files)
+        self.assertEqual(4, len(res))
+        self.assertEqual( [ 'Binary file matches' ]
+                        , [ l for f,i,l in res if f.endswith('.bin') ] )
+        self.assertEqual(3, len(self.search( 'hit', files
+                                        , self.options(binary_files='skip') )))
+        self.assertEqual(6, len(self.search( 'hit', files
+                                        , self.options(binary_files='text') )))
+        self.assertEqual(3, len(self.search( 'hit', files
+                                           , self.options(max_filesize=12) )))
+
+    def test_ignore_files(self):
+        root = self.make_tree({ '.gitignore'            : '# comment\n'
+                                                          '*.log\n'
+                                                          'build/\n'
+                                                          '/top.txt\n'
+                                                          '!keep.log\n'
+                              , 'a.txt'                 : 'hit\n'
+                              , 'top.txt'               : 'hit\n'
+                              , 'x.log'                 : 'hit\n'
+                              , 'keep.log'              : 'hit\n'
+                              , 'build/b.txt'           : 'hit\n'
+                              , 'sub/top.txt'           : 'hit\n'
+                              , 'sub/y.log'             : 'hit\n'
+                              , 'sub/.ignore'           : 'deep/**/*.txt\n'
+                              , 'sub/deep/1/2/c.txt'    : 'hit\n'
+                              , 'sub/deep/d.txt'        : 'hit\n'
+                              , 'sub/deep/e.log'        : 'hit\n'
+                              })
+        files = [ os.path.join(root, '*') ]
+        found = lambda res: sorted( os.path.relpath(f, root).replace(os.sep, '/')
+                                    for f,i,l in res )
+
+        res = self.search('hit', files, self.options(recurse=True))
+        self.assertEqual( [ 'a.txt', 'keep.log', 'sub/top.txt' ], found(res) )
+
+        res = self.search( 'hit', files
+                         , self.options(recurse=True, no_ignore=True) )
+        self.assertEqual(10, len(res))
+
+        # Without recursing, the ignore files are not consulted.
+        self.assertEqual(4, len(self.search('hit', files)))
+
+    def test_parallel(self):
+        search_string = r'xyzzy_8'
+        res = self.search( search_string, ['../*.py']
+                         , self.options(recurse=True, jobs=3) )
+        self.assertEqual(1, len(res))
+        self.assertIn(search_string, res[0][2])
+
+        files = [ sys.modules[__name__].__file__ ] * 2
+        self.assertEqual( self.search('def ', files)
+                        , self.search('def ', files, self.options(jobs=2)) )
+
+    def test_progress(self):
+        root = self.make_tree({ 'a.txt' : 'hit\n', 'b.txt' : 'miss\n' })
+        files = [ os.path.join(root, '*.txt') ]
+        for jobs in (1, 2):
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as err:
+                res = self.search( 'hit', files
+                                 , self.options(progress=True, jobs=jobs) )
+            self.assertEqual(self.search('hit', files), res)
+            self.assertIn('Files searched: 2 ', err.getvalue())
+            # Not a terminal, so the bar is only written once, plainly.
+            self.assertNotIn('\x1b', err.getvalue())
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+#Copyright 2026 Mark Santesson
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import grep
+
+
+''' Benchmarks for grep.py. A synthetic tree is generated (or reused), and
+the walk, read and whole search phases are timed separately over each part of
+it, so that changes to the walker or to the search engines can be
+compared between runs.
+'''
+
+
+# Words the filler lines are made of.
+VOCABULARY = ( 'alpha beta gamma delta epsilon zeta eta theta iota kappa'
+               ' lambda mu nu xi omicron pi rho sigma tau upsilon phi chi'
+               ' psi omega def class return import for while if else'
+             ).split()
+
+# Tokens planted in the corpus, and how often (one line in so many).
+RARE_TOKEN  = 'xyzzyRareToken'
+DENSE_TOKEN = 'denseToken'
+RARE_EVERY  = 20000
+DENSE_EVERY = 5
+
+# name: (description, number of files, lines per file, directory depth,
+#        directories per level)
+SHAPES = { 'small' : ( 'many small files', 4000, 40, 1, 40 )
+         , 'huge'  : ( 'a few huge files', 3, 200000, 0, 1 )
+         , 'deep'  : ( 'deeply nested directories', 512, 40, 8, 2 )
+         }
+
+# name: (pattern, extra grep options)
+SEARCHES = { 'rare'    : ( RARE_TOKEN, [] )
+           , 'dense'   : ( DENSE_TOKEN, [] )
+           , 'regex'   : ( r'\bx\w+Rare\w*', [] )
+           , 'nocase'  : ( RARE_TOKEN.upper(), [ '-i' ] )
+           }
+
+
+def _lines(rng, count):
+    '''Returns count lines of filler text with the tokens sprinkled in.'''
+    pool = [ ' '.join( rng.choice(VOCABULARY)
+                       for _ in range(rng.randint(4, 12)) ) + '\n'
+             for _ in range(1000) ]
+    lines = rng.choices(pool, k=count)
+    for i in range(0, count, DENSE_EVERY):
+        lines[i] = lines[i][:-1] + ' ' + DENSE_TOKEN + '\n'
+    for i in range(rng.randrange(RARE_EVERY), count, RARE_EVERY):
+        lines[i] = RARE_TOKEN + ' ' + lines[i]
+    return lines
+
+
+def _dirs(root, depth, fanout):
+    '''Returns the leaf directories of a tree depth levels deep with fanout
+    subdirectories in each.'''
+    dirs = [ root ]
+    for level in range(depth):
+        dirs = [ os.path.join(x, 'd%d' % i) for x in dirs
+                                            for i in range(fanout) ]
+    return dirs
+
+
+def generate(root, scale=1.0, seed=1):
+    '''Writes the synthetic corpus under root, one subdirectory per shape.
+    The same seed and scale always produce the same tree.'''
+    rng = random.Random(seed)
+    for shape,(desc,files,lines,depth,fanout) in sorted(SHAPES.items()):
+        files = max(1, int(files * scale))
+        leaves = _dirs(os.path.join(root, shape), depth, fanout)
+        for i in range(files):
+            leaf = leaves[i % len(leaves)]
+            if not os.path.isdir(leaf):
+                os.makedirs(leaf)
+            with open(os.path.join(leaf, 'f%05d.txt' % i), 'w') as f:
+                f.writelines(_lines(rng, lines))
+
+
+def _time(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def _read_all(filepaths):
+    size = 0
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            size += len(f.read())
+    return size
+
+
+def _rates(seconds, size, files):
+    seconds = max(seconds, 1e-9)
+    return { 'seconds'  : seconds
+           , 'mb_per_s' : size / seconds / 1e6
+           , 'files_per_s' : files / seconds
+           }
+
+
+def bench_one(root, shape, search, grep_args, repeat):
+    '''Times the phases of one search over one shape. The best of repeat
+    runs is kept for each phase. The searcher reads the files itself, so
+    the searched phase includes reading them again; the match phase is
+    that time less the read time.'''
+    pattern,extra = SEARCHES[search]
+    fileargs = [ os.path.join(root, shape, '*.txt') ]
+    options,_ = grep._option_parser().parse_args(
+                            [ '-r' ] + extra + grep_args + [ pattern ] )
+    search_re = grep._compile_patterns(options, [ pattern ])
+    searcher = grep._Searcher(options, search_re, [ pattern ])
+
+    walk = read = searched = None
+    for _ in range(repeat):
+        t,filepaths = _time(lambda: list(grep._iter_files(options, fileargs)))
+        walk = min(walk or t, t)
+
+        t,size = _time(lambda: _read_all(filepaths))
+        read = min(read or t, t)
+
+        if options.jobs > 1:
+            run = lambda: list(grep._search_parallel( options, searcher
+                                                    , iter(filepaths) ))
+        else:
+            run = lambda: list(grep._search_serial(searcher, filepaths))
+        t,results = _time(run)
+        searched = min(searched or t, t)
+
+    files = len(filepaths)
+    return { 'shape'   : shape
+           , 'search'  : search
+           , 'files'   : files
+           , 'bytes'   : size
+           , 'matches' : len(results)
+           , 'walk'    : _rates(walk, size, files)
+           , 'read'    : _rates(read, size, files)
+           , 'searched': _rates(searched, size, files)
+           , 'match'   : _rates(searched - read, size, files)
+           }
+
+
+def _report(row):
+    print( '%-6s %-7s %6d files %8.1f MB %7d hits' %
+           ( row['shape'], row['search'], row['files'], row['bytes'] / 1e6
+           , row['matches'] ) )
+    for phase in ('walk', 'read', 'searched', 'match'):
+        r = row[phase]
+        print( '    %-8s %8.3fs %10.1f MB/s %12.1f files/s' %
+               ( phase, r['seconds'], r['mb_per_s'], r['files_per_s'] ) )
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+                usage='%prog [options] [-- grep options]',
+                description='Benchmark grep.py over a synthetic tree. Any'
+                            ' arguments after the options are passed on to'
+                            ' grep.py, for example "-- --engine buffer -j 4".')
+    parser.add_option( '--corpus', dest='corpus', default=None, metavar='DIR'
+                     , help='Generate the corpus in DIR and keep it, or reuse'
+                            ' it if it is already there. Default is a'
+                            ' temporary directory that is removed afterwards.' )
+    parser.add_option( '--scale', dest='scale', type='float', default=1.0
+                     , help='Multiply the number of files by this much.'
+                            ' Default is %default.' )
+    parser.add_option( '--shape', dest='shapes', action='append', default=None
+                     , help='Only benchmark this shape (%s). Can be repeated.'
+                            % ', '.join(sorted(SHAPES)) )
+    parser.add_option( '--search', dest='searches', action='append'
+                     , default=None
+                     , help='Only benchmark this search (%s). Can be'
+                            ' repeated.' % ', '.join(sorted(SEARCHES)) )
+    parser.add_option( '--repeat', dest='repeat', type='int', default=3
+                     , help='Runs per measurement; the fastest is kept.'
+                            ' Default is %default.' )
+    parser.add_option( '--json', dest='json', default=None, metavar='FILE'
+                     , help='Also write the results to FILE as JSON.' )
+
+    options, grep_args = parser.parse_args()
+
+    root = options.corpus or tempfile.mkdtemp(prefix='grep_bench_')
+    try:
+        if not os.path.isdir(os.path.join(root, sorted(SHAPES)[0])):
+            print('Generating corpus in %s...' % root)
+            t,_ = _time(lambda: generate(root, options.scale))
+            print('    %.1fs' % t)
+
+        rows = list()
+        for shape in options.shapes or sorted(SHAPES):
+            for search in options.searches or sorted(SEARCHES):
+                row = bench_one(root, shape, search, grep_args, options.repeat)
+                _report(row)
+                rows.append(row)
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump( { 'grep_args' : grep_args, 'results' : rows }
+                         , f, indent=1, sort_keys=True )
+    finally:
+        if not options.corpus:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,124 @@
 
 
-def progress(p, length=60, last = [-1]):
-    if last[0]==-1:
+import sys
+import time
+
+
+class Progress:
+    '''A progress bar with a rate and, when the total is known, an ETA.
+    Call it (or update()) once per item; it only redraws every interval
+    seconds, and only reads the clock every so many calls, so it is cheap
+    to call from a tight loop. Each Progress keeps its own state, so any
+    number of them can be in use. To show several at once, give each a
+    different row: the number of lines above the cursor to draw on.
+    The total can be given, or changed, along the way. When out is not a
+    terminal the bar is not redrawn, and only its final state is written
+    when it is closed.'''
+
+    def __init__(self, total=None, label='', length=40, interval=0.1,
+                 out=None, row=0):
+        self.total = total
+        self.label = label
+        self.length = length
+        self.interval = interval
+        self.out = out if out is not None else sys.stderr
+        self.row = row
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.count = 0
+        self.start = time.monotonic()
+        self.__last_draw = None
+        self.__calls = 0
+        self.__countdown = 1    # Calls until the clock is next read.
+
+    def __call__(self, n=1, total=None):
+        '''Records n more items done. A new total can be given too.'''
+        if total is not None:
+            self.total = total
+        self.count += n
+        self.__calls += 1
+        self.__countdown -= 1
+        if self.__countdown <= 0:
+            self.__tick()
+
+    update = __call__
+
+    def __tick(self):
+        now = time.monotonic()
+        if self.__last_draw is None or now - self.__last_draw >= self.interval:
+            self.draw(now)
+        # Read the clock about four times per interval from now on.
+        calls_per_second = self.__calls / max(now - self.start, 1e-6)
+        self.__countdown = max(1, int(calls_per_second * self.interval / 4))
+
+    def text(self, now=None):
+        '''Returns the line the bar is drawn as.'''
+        elapsed = max((now or time.monotonic()) - self.start, 1e-6)
+        rate = self.count / elapsed
+        parts = [ self.label ] if self.label else []
+        if self.total:
+            done = min(1.0, self.count / float(self.total))
+            filled = int(done * self.length)
+            parts.append( '[%s%s] %3d%%' % ( '-' * filled
+                                           , ' ' * (self.length - filled)
+                                           , int(done * 100) ) )
+            parts.append( '%d/%d' % (self.count, self.total) )
+        else:
+            parts.append( '%d' % (self.count,) )
+        parts.append( '%.1f/s' % (rate,) )
+        if self.total and rate > 0 and self.count < self.total:
+            eta = int((self.total - self.count) / rate)
+            parts.append( 'ETA %d:%02d:%02d' % (eta // 3600, eta // 60 % 60, eta % 60) )
+        return ' '.join(parts)
+
+    def draw(self, now=None):
+        '''Redraws the bar now, however recently it was drawn.'''
+        now = now or time.monotonic()
+        self.__last_draw = now
+        if not self.tty:
+            return
+        line = '\r' + self.text(now) + '\x1b[K'    # Clear what was after it.
+        if self.row:
+            line = '\x1b[%dA%s\x1b[%dB\r' % (self.row, line, self.row)
+        self.out.write(line)
+        self.out.flush()
+
+    def clear(self):
+        '''Erases the bar, so that something else can be written on its
+        line. It comes back the next time it is redrawn.'''
+        if self.tty and not self.row:
+            self.out.write('\r\x1b[K')
+
+    def close(self):
+        '''Draws the final state of the bar and moves past it.'''
+        if not self.tty:
+            self.out.write(self.text() + '\n')
+            self.out.flush()
+            return
+        self.draw()
+        if not self.row:
+            self.out.write('\n')
+            self.out.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_drawn = None   # How much of the current progress() bar is drawn.
+
+def progress(p, length=60):
+    '''Draws a bar of dashes across the line as p goes from 0.0 to 1.0.
+    Once p reaches 1.0 the bar is finished and the next call starts a
+    new one.'''
+    global _drawn
+    if _drawn is None:
         print('[', end='')
-        last[0] = 0
-    length = 55
-    if int(p*length) > last[0]:
-        print('-'*(int(p*length)-last[0]), end='', flush=True)
-        last[0] = int(p*length)
+        _drawn = 0
+    if int(p*length) > _drawn:
+        print('-'*(int(p*length)-_drawn), end='', flush=True)
+        _drawn = int(p*length)
     if p==1.0:
         print(']')
+        _drawn = None
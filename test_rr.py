@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#Copyright 2026 Mark Santesson
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+''' Tests for rr. It is a script that refuses to be imported, so it is run
+as a separate process on a scratch directory.
+'''
+
+
+RR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rr')
+
+# How often rr checks whether the command has finished.
+RUN_CHECK_INTERVAL = 0.1
+
+
+class TestRr(unittest.TestCase):
+
+    def make_repo(self, git=True):
+        '''Creates a scratch directory holding a.txt, a git repository in
+        which it is untracked if git, and returns its path.'''
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        if git:
+            subprocess.run( [ 'git', 'init', '-q', root ], check=True )
+        with open(os.path.join(root, 'a.txt'), 'w') as f:
+            f.write('one\n')
+        return root
+
+    def run_rr(self, root, args, edit=None, seconds=4.0):
+        '''Runs rr in root with args, calls edit part way through, and
+        returns what it printed and the CPU seconds rr itself used.'''
+        proc = subprocess.Popen( [ sys.executable, RR, '--nocolor' ] + args
+                               , cwd=root, stdout=subprocess.PIPE
+                               , stderr=subprocess.STDOUT )
+        try:
+            time.sleep(seconds / 2)
+            if edit is not None:
+                edit()
+            time.sleep(seconds / 2)
+        finally:
+            proc.send_signal(signal.SIGINT)
+            out = proc.stdout.read()
+            proc.stdout.close()
+            usage = os.wait4(proc.pid, 0)[2]
+            proc.returncode = 0
+        return out.decode(), usage.ru_utime + usage.ru_stime
+
+    def edit(self, root, text='two\n'):
+        with open(os.path.join(root, 'a.txt'), 'w') as f:
+            f.write(text)
+
+    @unittest.skipIf(shutil.which('git') is None, 'git is not installed')
+    def test_github_settles(self):
+        # rr's own hash cache and history are untracked files in the work
+        # tree; writing them after a run must not set off another one.
+        root = self.make_repo()
+        out,_ = self.run_rr( root, [ '-g', '--hash', '--history', 'h.jsonl'
+                                   , '-c', 'echo RUN' ]
+                           , lambda: self.edit(root) )
+        self.assertEqual(2, out.splitlines().count('RUN'), out)
+
+    def test_hash_wait(self):
+        # With --hash --wait nothing runs at startup, whether the cache is
+        # new or carried over, unless a file changed while rr was stopped.
+        root = self.make_repo(git=False)
+        args = [ '--hash', '--wait', '-c', 'echo RUN', 'a.txt' ]
+        for text,runs in ( ('one\n', 0), ('one\n', 0), ('two\n', 1) ):
+            self.edit(root, text)
+            out,_ = self.run_rr(root, args, seconds=1.0)
+            self.assertEqual(runs, out.splitlines().count('RUN'), out)
+        self.assertTrue(os.path.exists(os.path.join(root, '.rr-hashes')))
+
+    def test_history_times(self):
+        # A run's time is taken when it exits, not when rr next looks.
+        root = self.make_repo(git=False)
+        self.run_rr( root, [ '--history', 'h.jsonl', '-c', 'true', 'a.txt' ]
+                   , seconds=1.0 )
+        with open(os.path.join(root, 'h.jsonl')) as f:
+            records = [ json.loads(line) for line in f ]
+        self.assertEqual(1, len(records))
+        self.assertEqual(0, records[0]['exit_code'])
+        self.assertLess(records[0]['wall'], RUN_CHECK_INTERVAL)
+
+    def test_idle_during_run(self):
+        # A change seen during a long run waits for it without rr spinning.
+        root = self.make_repo(git=False)
+        for extra in ( [], [ '--poll' ] ):
+            out,cpu = self.run_rr( root, extra + [ '-c', 'sleep 10', 'a.txt' ]
+                                 , lambda: self.edit(root) )
+            self.assertLess(cpu, 1.0, out)
+
+
+if __name__ == '__main__':
+    unittest.main()